@@ -0,0 +1,1005 @@
+#!/usr/bin/python3 -u
+"""
+Description: Benchmark the scanners and entry points against synthetic
+fixtures, with stub fuzzel, virsh and moonraker standing in for the real ones
+Author: thnikk
+"""
+import argparse
+import base64
+import glob
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse as up
+from decimal import Decimal
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+parser = argparse.ArgumentParser(description="Benchmark fuzzel scripts")
+parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                    default=[100, 1500], help="Fixture sizes to test.")
+parser.add_argument('-r', '--repeat', type=int, default=5,
+                    help="Number of runs per benchmark (best is kept).")
+parser.add_argument('--startup', action='store_true',
+                    help="Check entry point startup times against budgets.")
+parser.add_argument('--server', action='store_true',
+                    help="Run the startup checks through fuzzel-server.py.")
+parser.add_argument('--history', action='store_true',
+                    help="Only check that parallel history writes are kept.")
+parser.add_argument('-o', '--output', type=str,
+                    help="Write the results to a json file.")
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Milliseconds from starting an entry point to it spawning fuzzel, about
+# 35ms over the slowest of several runs of this tree
+STARTUP_BUDGETS = {
+    "fuzzel-game.py": 145,
+    "fuzzel-vm.py": 145,
+    "fuzzel-print.py": 150,
+    "fuzzel-ssh.py": 130,
+}
+STARTUP_ARGS = {
+    "fuzzel-vm.py": [],
+    "fuzzel-print.py": ["127.0.0.1:7125", "-n", "2"],
+}
+STUBS = {
+    # Record when fuzzel was spawned, then pick $PICK or cancel the menu
+    "fuzzel": 'date +%s.%N > "$STAMP"\n'
+              'cat > "${MENU:-/dev/null}"\n'
+              '[ -n "$PICK" ] && echo "$PICK" && exit 0\nexit 1',
+    # List the VMs in $VIRSH_LIST and accept any other command
+    "virsh": '[ "$1" = "list" ] && cat "$VIRSH_LIST"\nexit 0',
+    "notify-send": 'exit 0',
+    "mpv": 'exit 0',
+}
+RESULTS = []
+# Expressions both bc -l and fuzzel-calculator understand
+CALCULATOR_CORPUS = [
+    "1+2*3", "2/3", "-7/9", "10/4", "2^10", "2^-3", "(1+2)^20", "3^40/7",
+    "0.1+0.2", ".5*3", "1.25*-4", "123456789*987654321", "1/7+1/11",
+    "s(1)", "c(1)", "s(-2.5)", "c(10)", "a(1)*4", "a(0.3)", "a(-20)",
+    "l(2)", "l(10)/l(2)", "e(1)", "e(-3.5)", "e(l(5))", "sqrt(2)",
+    "sqrt(1000000)", "sqrt(0.5)*sqrt(2)", "2*a(1)/3", "(s(1)^2+c(1)^2)",
+    # Unary minus binds tighter than ^ in bc, including when an entry like
+    # ^2 continues from a negative result
+    "-2^2", "-3" + "^2", "-0.5^3", "2-3^2", "2*-3^2", "2^-2^2", "-s(1)^2",
+    # bc -l's remainder is taken at scale 20, not of integers
+    "7%3", "-7%3", "7.5%2", "2^10%7", "10%4",
+]
+
+MANIFEST = '''"AppState"
+{{
+\t"appid"\t\t"{appid}"
+\t"Universe"\t\t"1"
+\t"LauncherPath"\t\t"/home/user/.local/share/Steam/ubuntu12_32/steam"
+\t"name"\t\t"Synthetic Game {appid}"
+\t"StateFlags"\t\t"4"
+\t"installdir"\t\t"Synthetic Game {appid}"
+\t"LastUpdated"\t\t"1700000000"
+\t"SizeOnDisk"\t\t"12345678901"
+\t"buildid"\t\t"12345678"
+\t"LastOwner"\t\t"76561190000000000"
+\t"BytesToDownload"\t\t"0"
+\t"BytesDownloaded"\t\t"0"
+\t"AutoUpdateBehavior"\t\t"0"
+\t"AllowOtherDownloadsWhileRunning"\t\t"0"
+\t"ScheduledAutoUpdate"\t\t"0"
+\t"InstalledDepots"
+\t{{
+\t\t"{depot}"
+\t\t{{
+\t\t\t"manifest"\t\t"1234567890123456789"
+\t\t\t"size"\t\t"12345678901"
+\t\t}}
+\t}}
+\t"UserConfig"
+\t{{
+\t\t"name"\t\t"Synthetic Game {appid}"
+\t\t"language"\t\t"english"
+\t}}
+\t"MountedConfig"
+\t{{
+\t\t"language"\t\t"english"
+\t}}
+}}
+'''
+
+
+def load_script(name):
+    """ Import one of the hyphenated scripts as a module """
+    spec = importlib.util.spec_from_file_location(
+        name.replace('-', '_').removesuffix('.py'),
+        os.path.join(SCRIPT_DIR, name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def best_of(repeat, function, *args) -> float:
+    """ Get the fastest of several runs in milliseconds """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def record(name, size, milliseconds, **extra) -> None:
+    """ Print a result and keep it for the json output """
+    details = "".join(f"  {key} {value}" for key, value in extra.items())
+    print(f"{name:<24} {size:>6}: {milliseconds:9.2f}ms{details}")
+    RESULTS.append(
+        {"name": name, "size": size, "ms": round(milliseconds, 3), **extra})
+
+
+def make_steam(home, size) -> None:
+    """ Create a Steam library with the given number of manifests """
+    steamapps = f"{home}/.local/share/Steam/steamapps"
+    os.makedirs(steamapps)
+    for appid in range(size):
+        with open(f"{steamapps}/appmanifest_{appid}.acf", 'w',
+                  encoding='utf-8') as file:
+            file.write(MANIFEST.format(appid=appid, depot=appid + 1))
+
+
+def legacy_run_steam(config) -> dict:
+    """ Line-based manifest scan that run_steam replaced """
+    apps = {}
+    blacklist = ['proton', 'steam']
+    for path in ["~/.local/share/Steam"] + config.get("extra", []):
+        for manifest in glob.glob(
+                os.path.expanduser(f"{path}/steamapps/appmanifest*.acf")):
+            with open(manifest, 'r', encoding='utf-8') as file:
+                name = ""
+                appid = ""
+                for line in file:
+                    if "name" in line:
+                        name = line.split('"')[-2]
+                    if "appid" in line:
+                        appid = line.split('"')[-2]
+                if not any(item in name.lower() for item in blacklist) \
+                        and name and appid:
+                    apps[f"{name} [steam]"] = [
+                        "steam", f"steam://rungameid/{appid}"]
+    return apps
+
+
+def make_emulators(root, size) -> None:
+    """ Create switch and retroarch trees with the given number of games """
+    for game in range(size):
+        folder = f"{root}/switch/Game {game}"
+        os.makedirs(folder)
+        for part in ("base.nsp", "update.nsp", "dlc.nsp"):
+            with open(f"{folder}/{part}", 'w', encoding='utf-8') as file:
+                file.write(part)
+        core = ("snes", "gcn", "wii", "gba")[game % 4]
+        os.makedirs(f"{root}/roms/{core}", exist_ok=True)
+        for ext in ("sfc", "sav", "txt"):
+            with open(f"{root}/roms/{core}/Game_{game}.{ext}", 'w',
+                      encoding='utf-8') as file:
+                file.write(ext)
+
+
+def legacy_run_switch(game_dir, command) -> dict:
+    """ Glob and stat based switch scan that run_switch replaced """
+    games = {}
+    for path in glob.glob(f"{game_dir}/*"):
+        try:
+            path = sorted({
+                item: os.path.getsize(item)
+                for item in glob.glob(f"{path}/*")
+                if not os.path.isdir(item)
+            })[0]
+            games[path] = command + [path]
+        except IndexError:
+            pass
+    return games
+
+
+def legacy_run_retroarch(game_dir, cores) -> dict:
+    """ Glob based retroarch scan that run_retroarch replaced """
+    games = {}
+    for path in glob.glob(f"{os.path.expanduser(game_dir)}/*/*.*"):
+        if path.split('.')[-1] in ["txt", "sav"]:
+            continue
+        core = path.split('/')[-2]
+        if core in list(cores):
+            games[path] = ['retroarch', '-f', '-L', cores[core], path]
+    return games
+
+
+def make_heroic(home, size) -> str:
+    """ Create Heroic store caches with the given number of owned games per
+    store, a tenth of them installed, and return the install directory """
+    heroic = f"{home}/Games/Heroic"
+    config = f"{home}/.config/heroic"
+    for store in ("legendary", "gog"):
+        library = []
+        installed = []
+        for game in range(size):
+            folder = f"{store}-game-{game}"
+            library.append({
+                "app_name": f"{store}{game}", "title": f"{store} {game}",
+                "runner": store, "folder_name": folder,
+                "description": "A synthetic game. " * 20,
+                "art_cover": f"https://example.com/{store}/{game}.jpg",
+                "is_installed": game % 10 == 0})
+            # Only a few of the owned games are installed
+            if game % 10 == 0:
+                write_file(f"{heroic}/{folder}/game.exe", "")
+                installed.append({
+                    "app_name": f"{store}{game}", "appName": f"{store}{game}",
+                    "title": f"{store} {game}",
+                    "install_path": f"{heroic}/{folder}"})
+        write_file(f"{config}/store_cache/{store}_library.json",
+                   json.dumps({"library": library}))
+        if store == "legendary":
+            write_file(
+                f"{config}/legendaryConfig/legendary/installed.json",
+                json.dumps({game["app_name"]: game for game in installed}))
+        else:
+            write_file(f"{config}/gog_store/installed.json",
+                       json.dumps({"installed": installed}))
+    return heroic
+
+
+def legacy_run_heroic(install_dir) -> dict:
+    """ Exe glob and full store cache parse that run_heroic replaced """
+    installed = [
+        path.split('/')[-2] for path in glob.glob(
+            os.path.expanduser(f'{install_dir}/*/*.exe'))]
+    installed = list(set(installed))
+    games = {}
+    for library in glob.glob(os.path.expanduser(
+        "~/.config/heroic/store_cache/*_library.json"
+    )):
+        try:
+            with open(library, 'r', encoding='utf-8') as file:
+                library = json.load(file)
+                for game in library['library']:
+                    if game['folder_name'] in installed:
+                        runner = game['runner']
+                        name = f"{game['title']} [{runner}]"
+                        games[name] = \
+                            ["xdg-open", f"heroic://launch/{runner}"
+                                f"/{game['app_name']}"]
+        except KeyError:
+            pass
+    return games
+
+
+def use_home(game, home) -> None:
+    """ Point HOME and the game launcher's cache paths at a fixture """
+    os.environ['HOME'] = home
+    os.makedirs(f"{home}/.cache", exist_ok=True)
+    game.HEROIC_DIR = f"{home}/.config/heroic"
+    game.HEROIC_CACHE = f"{home}/.cache/fuzzel-game-heroic.json"
+    game.BOTTLES_CACHE = f"{home}/.cache/fuzzel-game-bottles.json"
+
+
+def count_calls(function, *args) -> int:
+    """ Count the filesystem calls a function makes through the os module """
+    names = ["stat", "lstat", "scandir", "listdir"]
+    originals = {name: getattr(os, name) for name in names}
+    count = 0
+
+    def wrap(original):
+        def wrapper(*wrapped_args, **kwargs):
+            nonlocal count
+            count += 1
+            return original(*wrapped_args, **kwargs)
+        return wrapper
+
+    for name, original in originals.items():
+        setattr(os, name, wrap(original))
+    try:
+        function(*args)
+    finally:
+        for name, original in originals.items():
+            setattr(os, name, original)
+    return count
+
+
+def bench_emulators(game, sizes, repeat) -> None:
+    """ Compare the scandir based scanners against the legacy glob scans """
+    cores = {"snes": "snes.so", "gcn": "dolphin.so", "wii": "dolphin.so"}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as root:
+            make_emulators(root, size)
+            for label, legacy, current, args in (
+                ("switch", legacy_run_switch, game.run_switch,
+                 (f"{root}/switch", ["yuzu"])),
+                ("retroarch", legacy_run_retroarch, game.run_retroarch,
+                 (f"{root}/roms", cores)),
+            ):
+                record(f"{label} legacy", size,
+                       best_of(repeat, legacy, *args),
+                       fs_calls=count_calls(legacy, *args))
+                record(label, size, best_of(repeat, current, *args),
+                       fs_calls=count_calls(current, *args))
+
+
+def bench_steam(game, sizes, repeat) -> None:
+    """ Compare run_steam against the legacy line-based scan """
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as home:
+            os.environ['HOME'] = home
+            make_steam(home, size)
+            record("steam legacy", size,
+                   best_of(repeat, legacy_run_steam, {}))
+            record("steam", size, best_of(repeat, game.run_steam, {}))
+
+
+def bench_heroic(game, sizes, repeat) -> None:
+    """ Compare run_heroic with a cold and warm title cache against the
+    legacy scan """
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as home:
+            use_home(game, home)
+            heroic = make_heroic(home, size)
+
+            def cold():
+                if os.path.exists(game.HEROIC_CACHE):
+                    os.remove(game.HEROIC_CACHE)
+                game.run_heroic(heroic)
+
+            record("heroic legacy", size,
+                   best_of(repeat, legacy_run_heroic, heroic))
+            record("heroic cold", size, best_of(repeat, cold))
+            record("heroic", size, best_of(repeat, game.run_heroic, heroic))
+
+
+def legacy_calculate(expression) -> str:
+    """ Fork bc and sed for an expression like fuzzel-calculator.sh """
+    return subprocess.run(
+        ["sh", "-c", "echo \"$1\" | bc -l | "
+         "sed '/\\./ s/\\.\\{0,1\\}0\\{1,\\}$//'", "sh", expression],
+        capture_output=True, check=True, text=True).stdout.strip()
+
+
+def bench_calculator(repeat) -> bool:
+    """ Time the in-process calculator against forking bc for each
+    expression. Returns False if any result differs from bc -l beyond its
+    last digit. """
+    calculator = load_script('fuzzel-calculator.py')
+
+    def calculate():
+        return [calculator.format_result(calculator.evaluate(expression))
+                for expression in CALCULATOR_CORPUS]
+
+    size = len(CALCULATOR_CORPUS)
+    milliseconds = best_of(repeat, calculate)
+    if not shutil.which("bc"):
+        print("bc isn't installed, skipping the comparison")
+        record("calculator", size, milliseconds)
+        return True
+    legacy = [legacy_calculate(expression)
+              for expression in CALCULATOR_CORPUS]
+    mismatches = [
+        (expression, expected, result) for expression, expected, result in
+        zip(CALCULATOR_CORPUS, legacy, calculate())
+        if abs(Decimal(result) - Decimal(expected)) > Decimal("1e-18")]
+    for expression, expected, result in mismatches:
+        print(f"{expression}: bc {expected}, calculator {result}",
+              file=sys.stderr)
+    record("calculator legacy", size, best_of(
+        repeat, lambda: [legacy_calculate(expression)
+                         for expression in CALCULATOR_CORPUS]))
+    record("calculator", size, milliseconds, mismatches=len(mismatches))
+    return not mismatches
+
+
+def legacy_filter_list(item_list, filter_strings, invert=False) -> list:
+    """ Nested loop filter that fuzzel-vm's filter_list replaced """
+    temp_list = [
+        item for item in item_list
+        for filter_string in filter_strings
+        if filter_string in item
+    ]
+    if invert:
+        return temp_list
+    return sorted(list(set(item_list) - set(temp_list)))
+
+
+def bench_filter(repeat) -> None:
+    """ Compare the compiled filter against the nested loop on tens of
+    thousands of names and hundreds of rules """
+    # pylint: disable=import-outside-toplevel
+    from common import compile_filter
+    names = [f"vm-{item % 97}-{item:05}-{'abcdefgh'[item % 8]}host"
+             for item in range(20000)]
+    words = [f"-{item:05}-" for item in range(0, 20000, 67)]
+    mixed = words[:200] + [f"glob:vm-{item}-*-a*" for item in range(50)] + \
+        [f"re:^vm-{item}-\\d+-[bc]" for item in range(50)]
+    size = len(names)
+
+    def compiled(rules):
+        passes = compile_filter(exclude=rules)
+        return sorted(name for name in names if passes(name))
+
+    record("filter legacy", size,
+           best_of(repeat, legacy_filter_list, names, words),
+           rules=len(words))
+    record("filter", size, best_of(repeat, compiled, words),
+           rules=len(words))
+    record("filter mixed", size, best_of(repeat, compiled, mixed),
+           rules=len(mixed))
+
+
+def record_uses(path, item, uses) -> None:
+    """ Record uses of an item like that many launches would """
+    # pylint: disable=import-outside-toplevel
+    from common import record_history
+    for _ in range(uses):
+        record_history(path, item)
+
+
+def bench_history(processes=50, uses=20) -> bool:
+    """ Record uses from many processes at once with a journal small enough
+    to compact every few writes. Returns False if any use was lost. """
+    # pylint: disable=import-outside-toplevel
+    import common
+    journal_size = common.JOURNAL_SIZE
+    common.JOURNAL_SIZE = 256
+    context = multiprocessing.get_context("fork")
+    try:
+        with tempfile.TemporaryDirectory() as cache:
+            path = f"{cache}/history.json"
+            workers = [
+                context.Process(target=record_uses,
+                                args=(path, f"item {item}", uses))
+                for item in range(processes)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            milliseconds = (time.perf_counter() - start) * 1000
+            history = common.load_history(path)
+            # Scores barely decay within a run, so each rounds to its uses
+            lost = sum(
+                uses - round(history.get(f"item {item}", [0])[0])
+                for item in range(processes))
+            leftovers = len(glob.glob(f"{cache}/*.tmp"))
+    finally:
+        common.JOURNAL_SIZE = journal_size
+    record("history parallel", processes * uses, milliseconds,
+           lost=lost, leftovers=leftovers)
+    return not lost and not leftovers
+
+
+def bench_ssh(repeat) -> None:
+    """ Time running a command on a local sshd with a fresh handshake and
+    through a master connection opened by fuzzel-ssh """
+    ssh = load_script('fuzzel-ssh.py')
+    command = ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=2",
+               "localhost", "true"]
+
+    def run(*options):
+        return subprocess.run(
+            command[:1] + list(options) + command[1:],
+            capture_output=True, check=False).returncode
+
+    if run() != 0:
+        print("No sshd accepting keys on localhost, skipping ssh")
+        return
+    with tempfile.TemporaryDirectory() as runtime:
+        ssh.CONTROL_DIR = f"{runtime}/fuzzel-ssh"
+        options = ssh.control_options("1m")
+        record("ssh handshake", 1, best_of(repeat, run))
+        ssh.warm_hosts(["localhost"], "1m")
+        try:
+            deadline = time.monotonic() + ssh.WARM_TIMEOUT
+            while run(*options, "-O", "check") != 0:
+                if time.monotonic() > deadline:
+                    print("Master connection didn't open, skipping ssh")
+                    return
+                time.sleep(0.05)
+            record("ssh master", 1, best_of(repeat, run, *options))
+        finally:
+            run(*options, "-O", "exit")
+
+
+def write_file(path, text) -> None:
+    """ Write a fixture file, creating its directory """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(text)
+
+
+def make_bottle(home, name, size) -> str:
+    """ Create a bottle with the given number of dependencies, variables and
+    programs and return its bottle.yml """
+    bottle = [f"Name: {name}", "Installed_Dependencies:"] + \
+        [f"- dependency{item}" for item in range(size)] + \
+        ["Environment_Variables:"] + \
+        [f"  VAR{item}: value{item}" for item in range(size)] + \
+        ["External_Programs:"]
+    for program in range(size):
+        bottle += [
+            f"  id{program}:",
+            f"    executable: program{program}.exe",
+            f"    name: Program {program}",
+            f"    path: C:/Programs/program{program}.exe"]
+    path = f"{home}/.local/share/bottles/bottles/{name}/bottle.yml"
+    write_file(path, "\n".join(bottle) + "\n")
+    return path
+
+
+def legacy_run_bottles(config) -> dict:
+    """ Pure python yaml parse of one bottle that run_bottles replaced """
+    # pylint: disable=import-outside-toplevel
+    import yaml
+    path = os.path.expanduser('~/.local/share/bottles')
+    with open(f'{path}/bottles/{config["bottle"]}/bottle.yml', 'r',
+              encoding='utf-8') as file:
+        return {
+            f"{info['name']} [bottles-{config['bottle']}]":
+                ['bottles-cli', 'run', 'run', '-b', config['bottle'], '-p',
+                 info['name']]
+            for info in yaml.safe_load(file)['External_Programs'].values()
+        }
+
+
+def bench_bottles(game, sizes, repeat) -> None:
+    """ Compare run_bottles with a cold and warm program cache against the
+    legacy parse """
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as home:
+            use_home(game, home)
+            make_bottle(home, "bench", size)
+            config = {"bottle": "bench"}
+
+            def cold():
+                if os.path.exists(game.BOTTLES_CACHE):
+                    os.remove(game.BOTTLES_CACHE)
+                game.run_bottles(config)
+
+            record("bottles legacy", size,
+                   best_of(repeat, legacy_run_bottles, config))
+            record("bottles cold", size, best_of(repeat, cold))
+            record("bottles", size, best_of(repeat, game.run_bottles, config))
+
+
+def make_launchers(home, size) -> dict:
+    """ Create a fixture for every launcher and return a matching config """
+    make_steam(home, size)
+    make_emulators(home, size)
+    heroic = make_heroic(home, size)
+    make_bottle(home, "bench", size)
+    for system in ("PS2", "PS3", "cemu"):
+        for game in range(size):
+            os.makedirs(f"{home}/{system}/Game {game}")
+            write_file(f"{home}/{system}/Game {game}.iso", "")
+    return {
+        "steam": {"enable": True},
+        "heroic": {"enable": True, "path": heroic},
+        "switch": {"enable": True, "path": f"{home}/switch",
+                   "command": ["yuzu"]},
+        "rpcs3": {"enable": True, "path": f"{home}/PS3"},
+        "pcsx2": {"enable": True, "path": f"{home}/PS2"},
+        "cemu": {"enable": True, "path": f"{home}/cemu"},
+        "retroarch": {"enable": True, "path": f"{home}/roms", "cores": {
+            "snes": "snes.so", "gcn": "dolphin.so", "wii": "dolphin.so"}},
+        "bottles": {"enable": True, "bottle": "bench"},
+    }
+
+
+def bench_launchers(game, sizes, repeat) -> None:
+    """ Time every launcher's scanner at each size """
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as home:
+            use_home(game, home)
+            config = make_launchers(home, size)
+            for launcher, settings in config.items():
+                record(f"scan {launcher}", size, best_of(
+                    repeat, game.scan_launcher, launcher, settings))
+
+
+# What the websocket stand-in reports before and after its status update
+WATCH_RESULT = {
+    "print_stats": {"state": "standby", "filename": ""},
+    "virtual_sdcard": {"progress": 0.25}}
+WATCH_UPDATE = {
+    "print_stats": {"state": "printing", "filename": "pro/part7.gcode"}}
+
+
+class Moonraker(BaseHTTPRequestHandler):
+    """ Minimal stand-in for the moonraker endpoints fuzzel-print uses """
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, don't let Nagle delay them
+    disable_nagle_algorithm = True
+    files = 0
+    # Paths of every command posted and the number of subscriptions
+    posted = []
+    subscribes = 0
+
+    def log_message(self, *_):
+        pass
+
+    def reply(self, result):
+        """ Send a json-rpc style result """
+        body = json.dumps({"result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_frame(self, message):
+        """ Send a json message in an unmasked websocket text frame """
+        payload = json.dumps(message).encode()
+        if len(payload) < 126:
+            header = struct.pack("!BB", 0x81, len(payload))
+        else:
+            header = struct.pack("!BBH", 0x81, 126, len(payload))
+        self.wfile.write(header + payload)
+        self.wfile.flush()
+
+    def read_frame(self):
+        """ Read a masked websocket frame from the client, returning its
+        opcode and payload """
+        first, second = self.rfile.read(2)
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack("!H", self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self.rfile.read(8))[0]
+        mask = self.rfile.read(4)
+        payload = bytes(
+            byte ^ mask[index % 4]
+            for index, byte in enumerate(self.rfile.read(length)))
+        return first & 0x0f, payload
+
+    def subscribed(self):
+        """ Wait for a subscription and answer it with WATCH_RESULT """
+        while True:
+            opcode, payload = self.read_frame()
+            # Close
+            if opcode == 0x8:
+                raise ConnectionError("closed")
+            if opcode != 0x1:
+                continue
+            request = json.loads(payload)
+            if request.get("method") == "printer.objects.subscribe":
+                Moonraker.subscribes += 1
+                self.send_frame({"jsonrpc": "2.0", "id": request["id"],
+                                 "result": {"eventtime": 1.0,
+                                            "status": WATCH_RESULT}})
+                return
+
+    def websocket(self):
+        """ Upgrade to a websocket and answer the subscription, ask for it
+        again with notify_klippy_ready, then send a partial update """
+        key = self.headers["Sec-WebSocket-Key"] + \
+            "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", base64.b64encode(
+            hashlib.sha1(key.encode()).digest()).decode())
+        self.end_headers()
+        self.close_connection = True
+        try:
+            self.subscribed()
+            self.send_frame({"jsonrpc": "2.0",
+                             "method": "notify_klippy_ready"})
+            self.subscribed()
+            self.send_frame({"jsonrpc": "2.0",
+                             "method": "notify_status_update",
+                             "params": [WATCH_UPDATE, 2.0]})
+            # Hold the connection until the watcher goes away
+            while self.read_frame()[0] != 0x8:
+                pass
+        except (OSError, ValueError):
+            pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Answer file, macro and status queries """
+        url = up.urlparse(self.path)
+        query = up.parse_qs(url.query)
+        match url.path:
+            case "/websocket":
+                self.websocket()
+            case "/server/files/list":
+                self.reply([
+                    {"path": f"pro/part{item}.gcode", "modified": item}
+                    for item in range(self.files)])
+            case "/server/files/directory":
+                if query.get("path") == ["gcodes"]:
+                    self.reply({"dirs": [{"dirname": "pro", "modified": 1}],
+                                "files": []})
+                else:
+                    self.reply({"dirs": [], "files": [
+                        {"filename": f"part{item}.gcode", "modified": item}
+                        for item in range(self.files)]})
+            case "/printer/gcode/help":
+                self.reply({"CANCEL_PRINT": "Cancel the print"})
+            case _:
+                self.reply({"status": {
+                    "print_stats": {"state": "printing",
+                                    "filename": "pro/part0.gcode"},
+                    "virtual_sdcard": {"progress": 0.5}, "webhooks": {}}})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Accept any command """
+        Moonraker.posted.append(self.path)
+        self.reply("ok")
+
+
+class SlowMoonraker(Moonraker):
+    """ Moonraker stand-in that answers after the status timeout """
+    delay = 3
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Answer like Moonraker, late """
+        time.sleep(self.delay)
+        super().do_GET()
+
+
+def serve_printers(handlers) -> tuple:
+    """ Serve a stand-in on consecutive ports for each handler, or leave
+    the port closed for None, like fuzzel-print.py -n expects. Returns the
+    first port and the servers. """
+    while True:
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            base = probe.getsockname()[1]
+        servers = []
+        try:
+            for offset, handler in enumerate(handlers):
+                if handler:
+                    servers.append(ThreadingHTTPServer(
+                        ("127.0.0.1", base + offset), handler))
+        except OSError:
+            for server in servers:
+                server.server_close()
+            continue
+        for server in servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return base, servers
+
+
+def bench_statuses() -> bool:
+    """ Run fuzzel-print.py -s against four printers, one slow and one
+    offline, and check the picker's labels and that polling took about
+    STATUS_TIMEOUT rather than the slow printer's delay. Returns False if
+    either is wrong. """
+    # fuzzel-print.py's STATUS_TIMEOUT
+    timeout = 1
+    expected = [
+        "1: printing 50% pro/part0.gcode", "2: offline", "3: offline",
+        "4: printing 50% pro/part0.gcode"]
+    with tempfile.TemporaryDirectory() as home:
+        env = make_stubs(home)
+        env["MENU"] = f"{home}/menu"
+        base, servers = serve_printers(
+            [Moonraker, SlowMoonraker, None, Moonraker])
+        try:
+            start = time.time()
+            run_script("fuzzel-print.py", env, f"127.0.0.1:{base}", "-n",
+                       str(len(expected)), "-s")
+            with open(env["STAMP"], 'r', encoding='utf-8') as file:
+                milliseconds = (float(file.read()) - start) * 1000
+            with open(env["MENU"], 'r', encoding='utf-8') as file:
+                labels = file.read().splitlines()
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+    # Start-up and importing requests take well under half a second
+    passed = labels == expected and \
+        milliseconds < (timeout + 0.5) * 1000 < SlowMoonraker.delay * 1000
+    if not passed:
+        print(f"Printer menu was {labels} after {milliseconds:.0f}ms",
+              file=sys.stderr)
+    record("print statuses", len(expected), milliseconds, passed=passed)
+    return passed
+
+
+def run_script(script, env, *arguments) -> float:
+    """ Run an entry point to completion in milliseconds """
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, os.path.join(SCRIPT_DIR, script)] + list(arguments),
+        env=env, capture_output=True, check=False)
+    return (time.perf_counter() - start) * 1000
+
+
+def bench_end_to_end(sizes, repeat) -> None:
+    """ Time fuzzel-vm.py and fuzzel-print.py from start to finish """
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as home:
+            env = make_stubs(home)
+            env["PICK"] = "0"
+            env["VIRSH_LIST"] = f"{home}/virsh-list"
+            write_file(env["VIRSH_LIST"], " Id   Name   State\n---\n" + "".join(
+                f" -    vm{vm}   shut off\n" for vm in range(size)))
+            record("end to end fuzzel-vm", size, min(
+                run_script("fuzzel-vm.py", env) for _ in range(repeat)))
+
+            Moonraker.files = size
+            server = ThreadingHTTPServer(("127.0.0.1", 0), Moonraker)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            address = f"127.0.0.1:{server.server_address[1]}"
+            record("end to end fuzzel-print", size, min(
+                run_script("fuzzel-print.py", env, address, "-n", "4", "-s")
+                for _ in range(repeat)))
+            server.shutdown()
+            server.server_close()
+
+
+def bench_watch() -> bool:
+    """ Run fuzzel-print.py --watch against the websocket stand-in and check
+    that the merged status it saves is what Reprint uses. Returns False if
+    either is wrong. """
+    if importlib.util.find_spec("websocket") is None:
+        print("websocket-client isn't installed, skipping the watcher")
+        return True
+    with tempfile.TemporaryDirectory() as home:
+        env = make_stubs(home)
+        status_file = f"{home}/.cache/fuzzel-print-status.json"
+        Moonraker.subscribes = 0
+        Moonraker.posted = []
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Moonraker)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        address = f"127.0.0.1:{server.server_address[1]}"
+        expected = {
+            "print_stats": WATCH_UPDATE["print_stats"],
+            "virtual_sdcard": WATCH_RESULT["virtual_sdcard"]}
+        start = time.perf_counter()
+        watcher = subprocess.Popen(
+            [sys.executable, os.path.join(SCRIPT_DIR, "fuzzel-print.py"),
+             address, "--watch"],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            merged = None
+            deadline = time.monotonic() + 10
+            while merged != expected and time.monotonic() < deadline:
+                time.sleep(0.01)
+                try:
+                    with open(status_file, 'r', encoding='utf-8') as file:
+                        merged = json.load(file).get(address)
+                except (OSError, ValueError):
+                    pass
+            milliseconds = (time.perf_counter() - start) * 1000
+            # Pick Reprint, which should use the watched file rather than
+            # the stand-in's http status
+            run_script("fuzzel-print.py", dict(env, PICK="1"), address)
+        finally:
+            watcher.terminate()
+            watcher.wait()
+            server.shutdown()
+            server.server_close()
+    reprinted = [
+        up.parse_qs(up.urlparse(path).query).get("filename")
+        for path in Moonraker.posted]
+    passed = merged == expected and Moonraker.subscribes == 2 and \
+        reprinted == [[WATCH_UPDATE["print_stats"]["filename"]]]
+    if not passed:
+        print(f"Watcher saved {merged}, subscribed {Moonraker.subscribes} "
+              f"times and reprinted {reprinted}", file=sys.stderr)
+    record("print watch", 1, milliseconds, passed=passed)
+    return passed
+
+
+def make_stubs(home) -> dict:
+    """ Create a home with stub executables and configs, returning the
+    environment the entry points should run in """
+    bindir = f"{home}/bin"
+    os.makedirs(bindir)
+    os.makedirs(f"{home}/.config/fuzzel")
+    os.makedirs(f"{home}/.cache")
+    for name, body in STUBS.items():
+        with open(f"{bindir}/{name}", 'w', encoding='utf-8') as file:
+            file.write(f"#!/bin/sh\n{body}\n")
+        os.chmod(f"{bindir}/{name}", 0o755)
+    configs = {
+        "fuzzel-game.json": {
+            "custom": {"enable": True, "games": {"Game": ["true"]}}},
+        "fuzzel-ssh.json": {"localhost": "user@127.0.0.1"},
+    }
+    for name, config in configs.items():
+        with open(f"{home}/.config/fuzzel/{name}", 'w',
+                  encoding='utf-8') as file:
+            file.write(json.dumps(config))
+    return dict(
+        os.environ, HOME=home, STAMP=f"{home}/stamp", XDG_RUNTIME_DIR=home,
+        PATH=f"{bindir}:{os.environ['PATH']}")
+
+
+def measure_startup(script, env) -> tuple:
+    """ Get the time to the first fuzzel spawn and the time spent importing
+    modules, both in milliseconds """
+    command = [sys.executable, os.path.join(SCRIPT_DIR, script)] + \
+        STARTUP_ARGS.get(script, [])
+    start = time.time()
+    subprocess.run(command, env=env, capture_output=True, check=False)
+    with open(env["STAMP"], 'r', encoding='utf-8') as file:
+        spawn = (float(file.read()) - start) * 1000
+    os.remove(env["STAMP"])
+    output = subprocess.run(
+        command[:1] + ["-X", "importtime"] + command[1:],
+        env=env, capture_output=True, check=False).stderr.decode()
+    imports = sum(
+        int(line.split('|')[0].split(':')[1])
+        for line in output.splitlines() if line.startswith("import time:")
+        and line.split('|')[0].split(':')[1].strip().isdigit()) / 1000
+    return spawn, imports
+
+
+def bench_startup(repeat, server=False) -> bool:
+    """ Check each entry point's startup time against its budget """
+    passed = True
+    with tempfile.TemporaryDirectory() as home:
+        env = make_stubs(home)
+        if server:
+            resident = subprocess.Popen(
+                [sys.executable, os.path.join(SCRIPT_DIR, "fuzzel-server.py")],
+                env=env)
+            while not os.path.exists(f"{home}/fuzzel-scripts.sock"):
+                time.sleep(0.01)
+        try:
+            for script, budget in STARTUP_BUDGETS.items():
+                spawn, imports = min(
+                    measure_startup(script, env) for _ in range(repeat))
+                status = "ok" if spawn <= budget else "OVER BUDGET"
+                passed = passed and spawn <= budget
+                print(f"{script:<16} first spawn {spawn:7.2f}ms "
+                      f"(budget {budget}ms, imports {imports:6.2f}ms) "
+                      f"{status}")
+        finally:
+            if server:
+                resident.terminate()
+                resident.wait()
+    return passed
+
+
+def main():
+    """ Main function """
+    args = parser.parse_args()
+    if args.startup:
+        if not bench_startup(args.repeat, args.server):
+            sys.exit(1)
+        return
+    if args.history:
+        if not bench_history():
+            sys.exit(1)
+        return
+    home = os.environ.get('HOME')
+    game = load_script('fuzzel-game.py')
+    try:
+        bench_steam(game, args.sizes, args.repeat)
+        bench_emulators(game, args.sizes, args.repeat)
+        bench_heroic(game, args.sizes, args.repeat)
+        bench_bottles(game, args.sizes, args.repeat)
+        bench_launchers(game, args.sizes, args.repeat)
+    finally:
+        if home is not None:
+            os.environ['HOME'] = home
+    bench_end_to_end(args.sizes, args.repeat)
+    passed = bench_calculator(args.repeat)
+    passed = bench_history() and passed
+    passed = bench_watch() and passed
+    passed = bench_statuses() and passed
+    bench_filter(args.repeat)
+    bench_ssh(args.repeat)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(RESULTS, indent=4))
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
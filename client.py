@@ -0,0 +1,59 @@
+#!/usr/bin/python3 -u
+"""
+Description: Client for fuzzel-server.py. The scripts import this before
+anything else, so it only imports what forwarding a request needs.
+Author: thnikk
+"""
+import json
+import os
+import socket
+import sys
+
+# Only forward to a socket in the user's own runtime directory, never /tmp
+SOCKET_FILE = None
+if os.environ.get("XDG_RUNTIME_DIR"):
+    SOCKET_FILE = os.path.join(
+        os.environ["XDG_RUNTIME_DIR"], "fuzzel-scripts.sock")
+# Set by fuzzel-server.py so the scripts it runs don't forward to it
+IN_SERVER = False
+
+
+def peer_uid(connection) -> int:
+    """ Get the uid of the process on the other end of a unix socket """
+    # struct ucred is pid, uid and gid as native ints
+    credentials = connection.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, 12)
+    return int.from_bytes(credentials[4:8], sys.byteorder)
+
+
+def forward() -> None:
+    """ Run the script in fuzzel-server.py if it's running, passing it the
+    arguments, environment and standard streams, and exit with its status.
+    Returns so the script can run standalone otherwise. """
+    if IN_SERVER or not SOCKET_FILE:
+        return
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        try:
+            client.connect(SOCKET_FILE)
+            # Never hand the environment and streams to another user
+            if peer_uid(client) != os.getuid():
+                return
+            request = json.dumps({
+                "argv": [os.path.abspath(sys.argv[0])] + sys.argv[1:],
+                "cwd": os.getcwd(), "env": dict(os.environ)
+            }).encode() + b"\n"
+            sent = socket.send_fds(client, [request], [0, 1, 2])
+            client.sendall(request[sent:])
+        except OSError:
+            return
+        reply = client.makefile('rb').readline()
+    try:
+        status = json.loads(reply)["status"]
+    except (ValueError, KeyError):
+        # The server died while running the script
+        sys.exit(1)
+    # The server doesn't run this script
+    if status is None:
+        return
+    sys.exit(status)
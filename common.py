@@ -3,19 +3,363 @@
 Description: Common module
 Author: thnikk
 """
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL
+from contextlib import contextmanager, nullcontext
+import copy
+import fcntl
+import fnmatch
+import json
+import os
+import re
 import sys
+import threading
+import time
 
+# Append timed spans as json lines to this file when set
+TRACE_FILE = os.environ.get("FUZZEL_SCRIPTS_TRACE")
+# Also dump a cProfile of the span with this name next to the trace
+PROFILE_SPAN = os.environ.get("FUZZEL_SCRIPTS_PROFILE")
+NULL_SPAN = nullcontext()
+# Parsed configs by path with the mtime and size they were read at
+CONFIGS = {}
+# Scores halve every two weeks without use
+HALF_LIFE = 14 * 24 * 60 * 60
+# Maximum number of items kept in a history file
+HISTORY_SIZE = 1000
+# Bytes of journal to collect before compacting it into the snapshot
+JOURNAL_SIZE = 16 * 1024
+
+
+def trace(name, **fields):
+    """ Time a phase of a script when FUZZEL_SCRIPTS_TRACE is set. Returns a
+    shared no-op context manager otherwise, so tracing costs nothing. """
+    if not TRACE_FILE:
+        return NULL_SPAN
+    return span(name, **fields)
+
+
+@contextmanager
+def span(name, **fields):
+    """ Record how long the body takes as a json line in the trace file """
+    profiler = None
+    if name == PROFILE_SPAN:
+        # pylint: disable=import-outside-toplevel
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.time()
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = (time.perf_counter() - begin) * 1000
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(
+                f"{TRACE_FILE}.{name.replace(' ', '-')}.prof")
+        line = json.dumps({
+            "script": os.path.basename(sys.argv[0]), "pid": os.getpid(),
+            "span": name, "start": start, "ms": round(duration, 3),
+            **fields}) + "\n"
+        # One append-mode write per span so threads and scripts don't mix
+        descriptor = os.open(
+            TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(descriptor, line.encode())
+        finally:
+            os.close(descriptor)
+
+
+def get_selection(items, prompt="", label=str, max_lines=8, index=True):
+    """ Get selection from fuzzel. Items can be any iterable, including a
+    generator, and are streamed to fuzzel as they're produced so the menu
+    opens before slow producers finish. Returns the selected item itself, or
+    the entered text if index is False. Exits if fuzzel is cancelled. """
+    if hasattr(items, '__len__'):
+        max_lines = min(len(items), max_lines)
+    command = ["fuzzel", "--dmenu", "-l", str(max_lines), "-p", prompt]
+    if index:
+        command.append("--index")
+    produced = []
+
+    def feed(stdin):
+        """ Write items to fuzzel, one write per item for generators """
+        try:
+            if isinstance(items, (list, tuple)):
+                produced.extend(items)
+                stdin.write("".join(
+                    clean_label(label(item)) for item in items).encode())
+            else:
+                for item in items:
+                    # Store the item before fuzzel can show it
+                    produced.append(item)
+                    stdin.write(clean_label(label(item)).encode())
+        except (OSError, ValueError):
+            # Fuzzel closed before everything was produced
+            pass
+        finally:
+            try:
+                stdin.close()
+            except OSError:
+                pass
 
-def get_selection(input_list, prompt="") -> str:
-    """ Get selection from list """
-    lines = str(min(len(input_list), 8))
     with Popen(
-        ["fuzzel", "--dmenu", "-l", lines, "-p", prompt],
-        stdin=PIPE, stdout=PIPE, stderr=PIPE
+        command, stdin=PIPE, stdout=PIPE, stderr=DEVNULL, bufsize=0
     ) as fuzzel:
-        selection = fuzzel.communicate(
-            input=bytes("\n".join(input_list), 'utf-8'))[0]
-        if fuzzel.returncode != 0:
-            sys.exit(1)
-        return selection.decode().strip()
+        feeder = threading.Thread(
+            target=feed, args=(fuzzel.stdin,), daemon=True)
+        feeder.start()
+        selection = fuzzel.stdout.read().decode().strip()
+    if fuzzel.returncode != 0:
+        sys.exit(1)
+    if not index:
+        return selection
+    # Fuzzel prints -1 if the input matched no entry
+    if not selection.isdigit() or int(selection) >= len(produced):
+        sys.exit(1)
+    return produced[int(selection)]
+
+
+def notify(subject, body):
+    """ Create notification """
+    print(body)
+    # pylint: disable=consider-using-with
+    Popen(['notify-send', subject, body])
+
+
+def clean_label(text) -> str:
+    """ Make text safe to use as a single fuzzel line """
+    return text.replace("\n", " ") + "\n"
+
+
+def load_json(path) -> dict:
+    """ Load a json cache file """
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def read_config(path):
+    """ Load a json config, reusing the parsed copy while the file is
+    unchanged. fuzzel-server.py keeps these warm for the scripts it runs.
+    Raises like open and json.load. """
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = CONFIGS.get(path)
+    if not cached or cached[0] != key:
+        with open(path, 'r', encoding='utf-8') as file:
+            cached = (key, json.load(file))
+        CONFIGS[path] = cached
+    # Callers are free to change what they get
+    return copy.deepcopy(cached[1])
+
+
+def save_json(path, data) -> None:
+    """ Atomically write a json cache file """
+    temp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as file:
+        file.write(json.dumps(data))
+    os.replace(temp_file, path)
+
+
+def pid_alive(pid_file) -> bool:
+    """ Check whether the process in a pid file is alive """
+    try:
+        with open(pid_file, 'r', encoding='utf-8') as file:
+            os.kill(int(file.read()), 0)
+        return True
+    except (FileNotFoundError, ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+
+
+def extension(name) -> str:
+    """ Get the lowercase extension of a file name without the dot """
+    return name.rpartition('.')[2].lower() if '.' in name else ""
+
+
+def scan_dir(path, depth=1, include=None, exclude=None,
+             files=True, dirs=True, hidden=False):
+    """ Walk a directory tree with os.scandir, listing each directory exactly
+    once. Yields DirEntry objects, whose cached file type means callers don't
+    need to stat anything. include and exclude are lists of file extensions
+    without the dot and don't apply to directories. Names starting with a
+    dot are skipped like glob does unless hidden is set. """
+    try:
+        with os.scandir(os.path.expanduser(path)) as entries:
+            entries = list(entries)
+    except OSError:
+        return
+    for entry in entries:
+        if not hidden and entry.name.startswith('.'):
+            continue
+        if entry.is_dir():
+            if dirs:
+                yield entry
+            if depth > 1:
+                yield from scan_dir(
+                    entry.path, depth - 1, include, exclude, files, dirs,
+                    hidden)
+        elif files:
+            ext = extension(entry.name)
+            if include is not None and ext not in include:
+                continue
+            if exclude is not None and ext in exclude:
+                continue
+            yield entry
+
+
+def trie_pattern(words) -> str:
+    """ Build a regex matching any of the words, sharing common prefixes so
+    each position is checked against a trie instead of every word """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        # Longer words with this prefix can't match where it doesn't
+        node.clear()
+        node[""] = True
+
+    def pattern(node):
+        if "" in node:
+            return ""
+        branches = [re.escape(char) + pattern(child)
+                    for char, child in sorted(node.items())]
+        if len(branches) == 1:
+            return branches[0]
+        return f"(?:{'|'.join(branches)})"
+
+    return pattern(trie)
+
+
+def rules_matcher(rules, ignore_case=False):
+    """ Compile filter rules into a function that checks whether a name
+    matches any of them. Rules are substrings, "glob:" patterns matched
+    against the whole name or "re:" patterns searched for in it. Globs are
+    only tried at the start, the rest are searched for with one regex, where
+    a "re:" rule can still anchor itself with ^. """
+    flags = re.IGNORECASE if ignore_case else 0
+    words = []
+    searched = []
+    anchored = []
+    for rule in rules:
+        if rule.startswith("re:"):
+            # Searched even with a leading ^, which may only anchor one
+            # branch of an alternation like ^a|b
+            searched.append(rule[3:])
+        elif rule.startswith("glob:"):
+            anchored.append(fnmatch.translate(rule[5:]))
+        else:
+            words.append(rule.lower() if ignore_case else rule)
+    if words:
+        searched.append(trie_pattern(words))
+    search = re.compile("|".join(
+        f"(?:{pattern})" for pattern in searched), flags).search \
+        if searched else None
+    match = re.compile("|".join(
+        f"(?:{pattern})" for pattern in anchored), flags).match \
+        if anchored else None
+
+    def matches(name) -> bool:
+        return bool(search and search(name) or match and match(name))
+
+    return matches
+
+
+def compile_filter(include=None, exclude=None, ignore_case=False):
+    """ Compile include and exclude rules into a function that checks whether
+    a name passes. Names pass include if it is None or they match a rule,
+    and pass exclude if they match none. """
+    included = rules_matcher(include or [], ignore_case)
+    excluded = rules_matcher(exclude or [], ignore_case)
+
+    def passes(name) -> bool:
+        if include is not None and not included(name):
+            return False
+        return not excluded(name)
+
+    return passes
+
+
+def decay(entry, now) -> float:
+    """ Get the decayed score of a history entry """
+    score, last_used = entry
+    return score * 0.5 ** (max(0, now - last_used) / HALF_LIFE)
+
+
+def read_snapshot(path) -> dict:
+    """ Read a compacted frecency history snapshot """
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            history = json.load(file)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+    # Convert old most-recent-first lists into counts
+    if isinstance(history, list):
+        now = time.time()
+        counts = {}
+        for item in history:
+            counts[item] = counts.get(item, 0) + 1
+        return {item: [count, now] for item, count in counts.items()}
+    return history
+
+
+def replay_journal(journal, history) -> None:
+    """ Apply the uses recorded in an open journal file to a history """
+    journal.seek(0)
+    for line in journal:
+        try:
+            item, now = json.loads(line)
+        except (json.decoder.JSONDecodeError, ValueError, TypeError):
+            # Skip lines torn by a crash mid-write
+            continue
+        add_history(history, item, now)
+
+
+def load_history(path) -> dict:
+    """ Load a frecency history mapping items to [score, last used]. Uses
+    are appended to a journal next to the snapshot and replayed here. """
+    with open(f"{path}.journal", 'a+', encoding='utf-8') as journal:
+        fcntl.flock(journal, fcntl.LOCK_SH)
+        history = read_snapshot(path)
+        replay_journal(journal, history)
+    return history
+
+
+def add_history(history, item, now=None) -> None:
+    """ Record a use of an item, evicting the lowest scores if full """
+    now = time.time() if now is None else now
+    history[item] = [decay(history.get(item, [0, now]), now) + 1, now]
+    # Never evict the item that was just used
+    while len(history) > HISTORY_SIZE:
+        del history[min(
+            (key for key in history if key != item),
+            key=lambda key: decay(history[key], now))]
+
+
+def record_history(path, item) -> None:
+    """ Append a use of an item to the history journal. The journal is folded
+    into the snapshot once it grows past JOURNAL_SIZE, so a write never
+    depends on the size of the history and concurrent writes aren't lost. """
+    with open(f"{path}.journal", 'a+', encoding='utf-8') as journal:
+        fcntl.flock(journal, fcntl.LOCK_EX)
+        journal.write(json.dumps([item, time.time()]) + "\n")
+        journal.flush()
+        if journal.tell() < JOURNAL_SIZE:
+            return
+        history = read_snapshot(path)
+        replay_journal(journal, history)
+        save_json(path, history)
+        journal.truncate(0)
+
+
+def rank_history(candidates, history, now=None) -> list:
+    """ Sort candidates by frecency, keeping the original order for items
+    with equal scores and for items that aren't in the history """
+    now = time.time() if now is None else now
+    return sorted(candidates, key=lambda item: -decay(
+        history[item], now) if item in history else 0)
@@ -0,0 +1,259 @@
+#!/usr/bin/python3 -u
+"""
+Description: Calculator with fuzzel. Each expression continues from the last
+result like bc and entering y copies the result. Previous results are listed
+by frecency to start from before anything is entered, use shift+enter to
+enter an expression that matches one. Arithmetic is exact with fractions and functions are calculated
+with decimals, all in this process.
+Author: thnikk
+"""
+from decimal import Decimal, ROUND_DOWN, localcontext, getcontext
+from fractions import Fraction
+from subprocess import run
+import ast
+import operator
+import os
+import sys
+from common import get_selection, load_history, record_history, rank_history
+
+HISTORY_FILE = os.path.expanduser('~/.cache/fuzzel-calculator.json')
+# Decimal places kept in results, like bc -l
+SCALE = 20
+# Significant digits functions are calculated to before rounding to SCALE
+PRECISION = SCALE + 10
+# Don't calculate integer powers with more bits than this
+MAX_BITS = 1000000
+
+
+def decimal_pi() -> Decimal:
+    """ Pi to the current precision, from the decimal module's recipes """
+    getcontext().prec += 2
+    three = Decimal(3)
+    lasts, term, total, n, na, d, da = 0, three, 3, 1, 0, 0, 24
+    while total != lasts:
+        lasts = total
+        n, na = n + na, na + 8
+        d, da = d + da, da + 32
+        term = (term * n) / d
+        total += term
+    getcontext().prec -= 2
+    return +total
+
+
+def decimal_sin(x) -> Decimal:
+    """ Sine of x in radians with a taylor series """
+    getcontext().prec += 2
+    x %= 2 * decimal_pi()
+    i, lasts, total, fact, num, sign = 1, 0, x, 1, x, 1
+    while total != lasts:
+        lasts = total
+        i += 2
+        fact *= i * (i - 1)
+        num *= x * x
+        sign *= -1
+        total += num / fact * sign
+    getcontext().prec -= 2
+    return +total
+
+
+def decimal_cos(x) -> Decimal:
+    """ Cosine of x in radians with a taylor series """
+    getcontext().prec += 2
+    x %= 2 * decimal_pi()
+    i, lasts, total, fact, num, sign = 0, 0, 1, 1, 1, 1
+    while total != lasts:
+        lasts = total
+        i += 2
+        fact *= i * (i - 1)
+        num *= x * x
+        sign *= -1
+        total += num / fact * sign
+    getcontext().prec -= 2
+    return +total
+
+
+def decimal_tan(x) -> Decimal:
+    """ Tangent of x in radians """
+    return decimal_sin(x) / decimal_cos(x)
+
+
+def decimal_atan(x) -> Decimal:
+    """ Arctangent of x in radians with a taylor series """
+    if x < 0:
+        return -decimal_atan(-x)
+    getcontext().prec += 2
+    # atan(x) = 2 atan(x / (1 + sqrt(1 + x^2))) until the series converges
+    # quickly
+    doublings = 0
+    while x > Decimal("0.2"):
+        x /= 1 + (1 + x * x).sqrt()
+        doublings += 1
+    i, lasts, total, num, sign = 1, 0, x, x, 1
+    while total != lasts:
+        lasts = total
+        i += 2
+        num *= x * x
+        sign *= -1
+        total += num / i * sign
+    getcontext().prec -= 2
+    return +(total * 2 ** doublings)
+
+
+CONSTANTS = {
+    "pi": decimal_pi,
+    "e": lambda: Decimal(1).exp(),
+}
+# bc -l's single letter names and the usual ones
+FUNCTIONS = {
+    "sqrt": Decimal.sqrt,
+    "s": decimal_sin, "sin": decimal_sin,
+    "c": decimal_cos, "cos": decimal_cos,
+    "tan": decimal_tan,
+    "a": decimal_atan, "atan": decimal_atan,
+    "l": Decimal.ln, "ln": Decimal.ln,
+    "log": Decimal.log10,
+    "e": Decimal.exp, "exp": Decimal.exp,
+    "abs": abs,
+}
+
+
+def to_decimal(value) -> Decimal:
+    """ Convert a fraction to a decimal in the current context """
+    return Decimal(value.numerator) / Decimal(value.denominator)
+
+
+def power(base, exponent) -> Fraction:
+    """ Raise to a power, exactly for integer exponents """
+    if exponent.denominator == 1:
+        bits = max(base.numerator.bit_length(), base.denominator.bit_length())
+        if bits * abs(exponent.numerator) > MAX_BITS:
+            raise OverflowError("Result too large")
+        return base ** exponent.numerator
+    with localcontext() as context:
+        context.prec = PRECISION
+        return Fraction(to_decimal(base) ** to_decimal(exponent))
+
+
+def remainder(dividend, divisor) -> Fraction:
+    """ Remainder like bc -l, which subtracts the quotient truncated to
+    SCALE places rather than to an integer, so 7%3 is 10^-20 and not 1 """
+    quotient = Fraction(int(dividend / divisor * 10 ** SCALE), 10 ** SCALE)
+    return dividend - divisor * quotient
+
+
+BINARY = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: remainder,
+    ast.Pow: power,
+}
+UNARY = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+def evaluate_node(node, source) -> Fraction:
+    """ Evaluate an arithmetic expression node, refusing anything else """
+    match node:
+        case ast.Constant(value=bool()):
+            pass
+        case ast.Constant(value=int()):
+            return Fraction(node.value)
+        case ast.Constant(value=float()):
+            # Use the literal, the float has already lost precision
+            return Fraction(Decimal(ast.get_source_segment(source, node)))
+        case ast.BinOp(op=op, left=left, right=right) if type(op) in BINARY:
+            return BINARY[type(op)](
+                evaluate_node(left, source), evaluate_node(right, source))
+        case ast.UnaryOp(op=op, operand=operand) if type(op) in UNARY:
+            return UNARY[type(op)](evaluate_node(operand, source))
+        case ast.Name(id=name) if name in CONSTANTS:
+            with localcontext() as context:
+                context.prec = PRECISION
+                return Fraction(CONSTANTS[name]())
+        case ast.Call(func=ast.Name(id=name), args=[arg], keywords=[]) \
+                if name in FUNCTIONS:
+            value = evaluate_node(arg, source)
+            with localcontext() as context:
+                context.prec = PRECISION
+                return Fraction(FUNCTIONS[name](to_decimal(value)))
+    raise ValueError(
+        f"Unsupported expression: {ast.get_source_segment(source, node)}")
+
+
+class UnaryFirst(ast.NodeTransformer):
+    """ Give unary minus and plus precedence over powers like bc, so -2^2
+    is 4 rather than Python's -4 """
+
+    def visit_UnaryOp(self, node):  # pylint: disable=invalid-name
+        """ Move the sign onto the base of a power it applies to """
+        self.generic_visit(node)
+        if type(node.op) in UNARY and isinstance(node.operand, ast.BinOp) \
+                and isinstance(node.operand.op, ast.Pow):
+            power_node = node.operand
+            power_node.left = ast.copy_location(
+                ast.UnaryOp(op=node.op, operand=power_node.left), node)
+            return ast.copy_location(power_node, node)
+        return node
+
+
+def evaluate(expression) -> Fraction:
+    """ Evaluate an expression written for bc, where ^ is a power """
+    source = expression.replace("^", "**")
+    tree = UnaryFirst().visit(ast.parse(source, mode="eval"))
+    return evaluate_node(tree.body, source)
+
+
+def format_result(value) -> str:
+    """ Format a result truncated to SCALE decimal places without trailing
+    zeroes """
+    if value.denominator == 1:
+        return str(value.numerator)
+    with localcontext() as context:
+        context.prec = len(str(abs(int(value)))) + SCALE + 1
+        context.rounding = ROUND_DOWN
+        result = to_decimal(value).quantize(Decimal(1).scaleb(-SCALE))
+    if not result:
+        return "0"
+    return format(result, "f").rstrip("0").rstrip(".")
+
+
+def main():
+    """ Main function """
+    last = ""
+    message = ""
+    # Don't stop until the user hits escape or clicks off of fuzzel
+    while True:
+        history = load_history(HISTORY_FILE)
+        prompt = f"({message}) {last} " if message else f"{last} "
+        # Only offer results to start from, so input continuing from the
+        # last result can't match one
+        choices = [] if last else rank_history(list(history), history)
+        entry = get_selection(choices, prompt, index=False)
+        message = ""
+        # Quit if empty
+        if not entry:
+            sys.exit(1)
+        # Copy and exit if y is entered
+        if entry == "y":
+            run(["wl-copy", last], check=False)
+            sys.exit(0)
+        # Picking an earlier result starts from it
+        if not last and entry in history:
+            last = entry
+            continue
+        try:
+            last = format_result(evaluate(last + entry))
+        except (SyntaxError, ValueError, ArithmeticError) as error:
+            message = type(error).__name__
+            print(f"{message}: {error}", file=sys.stderr)
+            continue
+        record_history(HISTORY_FILE, last)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,83 +3,262 @@
 Description: Unified fuzzel game launcher
 Author: thnikk
 """
+# pylint: disable=wrong-import-position
+if __name__ == "__main__":
+    # Hand off to fuzzel-server.py before paying for any imports
+    import client
+    client.forward()
+
+import argparse
 import glob
 import os
+import re
+import signal
 import sys
 import json
-import yaml
-from subprocess import Popen, PIPE, run
-
-
-def get_selection(input_list, prompt="") -> str:
-    """ Get selection from list with custom prompt """
-    length = str(min(len(input_list), 8))
-    with Popen(
-        ["fuzzel", "--dmenu", "-l", length, "-p", prompt],
-        stdin=PIPE, stdout=PIPE, stderr=PIPE
-    ) as fuzzel:
-        selection = fuzzel.communicate(
-            input=bytes("\n".join(input_list), 'utf-8'))[0]
-        if fuzzel.returncode != 0:
-            sys.exit(1)
-        return selection.decode().strip()
+import threading
+import time
+from subprocess import Popen
+from common import (
+    get_selection, scan_dir, load_history, record_history, rank_history,
+    load_json, save_json, pid_alive, trace, read_config,
+    compile_filter, notify)
+
+CONFIG_FILE = os.path.expanduser("~/.config/fuzzel/fuzzel-game.json")
+INDEX_FILE = os.path.expanduser('~/.cache/fuzzel-game-index.json')
+TABLE_FILE = os.path.expanduser('~/.cache/fuzzel-game-table.json')
+PID_FILE = os.path.expanduser('~/.cache/fuzzel-game.pid')
+HEROIC_DIR = os.path.expanduser("~/.config/heroic")
+HEROIC_CACHE = os.path.expanduser('~/.cache/fuzzel-game-heroic.json')
+BOTTLES_CACHE = os.path.expanduser('~/.cache/fuzzel-game-bottles.json')
+# Where each of Heroic's stores keeps its list of installed games
+HEROIC_INSTALLED = {
+    "legendary": "legendaryConfig/legendary/installed.json",
+    "gog": "gog_store/installed.json",
+    "nile": "nile_config/nile/installed.json",
+}
+VDF_TOKEN = re.compile(
+    rb'\s*(?:"([^"\\]*(?:\\.[^"\\]*)*)"|([{}])|//[^\n]*|([^\s{}"]+))')
+STEAM_KEYS = {"appid", "name", "stateflags"}
+# Bytes of a VDF file to look for top-level keys in before reading the rest
+VDF_PREFIX = 4096
+STEAM_TOOLS = ["proton", "steam"]
+# Seconds to wait for a launcher's scan before skipping it
+DEFAULT_TIMEOUT = 5
+
+parser = argparse.ArgumentParser(description="Unified fuzzel game launcher")
+parser.add_argument('--daemon', action='store_true',
+                    help="Keep the game table up to date in the background.")
+parser.add_argument('--interval', type=int, default=30,
+                    help="Seconds between polls for network filesystems.")
+
+
+def vdf_tokens(data):
+    """ Lazily tokenize Valve KeyValues (VDF) data """
+    for match in VDF_TOKEN.finditer(data):
+        # Comments don't capture a group
+        if match.lastindex:
+            yield match.group(match.lastindex).decode('utf-8', 'replace')
+
+
+def read_vdf_keys(file, keys) -> dict:
+    """ Read top-level keys from a VDF file opened in binary mode, stopping
+    once all are found. Nested blocks are skipped so their keys can't shadow
+    top-level ones. """
+    # Fast path: manifests list the keys we want near the top as plain
+    # "key" "value" lines before the first nested block, so only read the
+    # start of the file. Anything unusual on those lines (escapes, comments)
+    # falls through to the full tokenizer on the whole file. A line cut off
+    # at the end of the prefix is missing its closing quote and is skipped.
+    data = file.read(VDF_PREFIX)
+    start = data.find(b"{") + 1
+    end = len(data)
+    for brace in (data.find(b"{", start), data.find(b"}", start)):
+        if brace != -1:
+            end = min(end, brace)
+    found = {}
+    for line in data[start:end].split(b"\n"):
+        parts = line.split(b'"')
+        if len(parts) != 5 or parts[0].strip() or b"\\" in parts[3]:
+            continue
+        key = parts[1].decode('utf-8', 'replace').lower()
+        if key in keys:
+            found[key] = parts[3].decode('utf-8', 'replace')
+            if len(found) == len(keys):
+                return found
+
+    data += file.read()
+    found = {}
+    depth = 0
+    key = None
+    for token in vdf_tokens(data):
+        if token == "{":
+            depth += 1
+            key = None
+        elif token == "}":
+            depth -= 1
+            key = None
+        elif depth != 1:
+            continue
+        elif key is None:
+            key = token
+        else:
+            if key.lower() in keys:
+                found[key.lower()] = token
+                if len(found) == len(keys):
+                    break
+            key = None
+    return found
+
+
+def parse_vdf(file) -> dict:
+    """ Parse a whole VDF file opened in binary mode into nested dicts """
+    root = {}
+    stack = [root]
+    key = None
+    for token in vdf_tokens(file.read()):
+        if token == "{":
+            block = {}
+            stack[-1][key] = block
+            stack.append(block)
+            key = None
+        elif token == "}":
+            if len(stack) > 1:
+                stack.pop()
+            key = None
+        elif key is None:
+            key = token
+        else:
+            stack[-1][key] = token
+            key = None
+    return root
+
+
+def steam_libraries(config) -> list:
+    """ Get Steam library folders from libraryfolders.vdf and the config """
+    root = os.path.expanduser("~/.local/share/Steam")
+    paths = [root]
+    try:
+        with open(f"{root}/steamapps/libraryfolders.vdf", 'rb') as file:
+            folders = parse_vdf(file)
+        folders = next(iter(folders.values()), {})
+        for key, value in folders.items():
+            # Older files map indices straight to paths
+            if isinstance(value, dict):
+                paths.append(value.get("path", ""))
+            elif key.isdigit():
+                paths.append(value)
+    except FileNotFoundError:
+        pass
+    paths += [os.path.expanduser(path) for path in config.get("extra", [])]
+    unique = {}
+    for path in paths:
+        if path:
+            unique.setdefault(os.path.realpath(path), path)
+    return list(unique.values())
 
 
 def run_steam(config) -> dict:
     """ Run steam game """
     apps = {}
-    blacklist = ['proton', 'steam']
-    if "extra" in config:
-        extra = config["extra"]
-    else:
-        extra = []
-    for path in ["~/.local/share/Steam"] + extra:
-        for manifest in glob.glob(
-                os.path.expanduser(
-                f"{path}/steamapps/appmanifest*.acf")):
-            with open(manifest, 'r', encoding='utf-8') as file:
-                name = ""
-                appid = ""
-                for line in file:
-                    if "name" in line:
-                        name = line.split('"')[-2]
-                    if "appid" in line:
-                        appid = line.split('"')[-2]
-                in_blacklist = False
-                for item in blacklist:
-                    if item in name.lower():
-                        in_blacklist = True
-                if not in_blacklist and name and appid:
-                    name = f"{name} [steam]"
-                    apps[name] = ["steam", f"steam://rungameid/{appid}"]
+    # Proton, the Steam runtimes and other tools are installed like games
+    is_game = compile_filter(exclude=STEAM_TOOLS, ignore_case=True)
+    for path in steam_libraries(config):
+        for manifest in glob.glob(f"{path}/steamapps/appmanifest*.acf"):
+            with open(manifest, 'rb') as file:
+                info = read_vdf_keys(file, STEAM_KEYS)
+            name = info.get("name", "")
+            appid = info.get("appid", "")
+            # Skip apps that aren't fully installed (StateFlags bit 4)
+            flags = info.get("stateflags", "4")
+            if flags.isdigit() and not int(flags) & 4:
+                continue
+            if name and appid and is_game(name):
+                name = f"{name} [steam]"
+                apps[name] = ["steam", f"steam://rungameid/{appid}"]
     return apps
 
 
+def heroic_installed():
+    """ Get (runner, app name, title) for every game Heroic's stores have
+    installed, or None if there's no install metadata to read """
+    found = False
+    installed = []
+    for runner, path in HEROIC_INSTALLED.items():
+        try:
+            with open(f"{HEROIC_DIR}/{path}", 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            continue
+        found = True
+        match runner:
+            # {app_name: {title, is_dlc, ...}}
+            case "legendary":
+                installed += [
+                    (runner, app, game.get('title', app))
+                    for app, game in data.items() if not game.get('is_dlc')]
+            # {"installed": [{appName, ...}]}
+            case "gog":
+                installed += [
+                    (runner, game['appName'], None)
+                    for game in data.get('installed', [])
+                    if not game.get('is_dlc')]
+            # [{id, ...}]
+            case "nile":
+                installed += [(runner, game['id'], None) for game in data]
+    return installed if found else None
+
+
+def heroic_titles() -> dict:
+    """ Get the title and install folder of every game in Heroic's library
+    by runner and app name. The store cache holds the whole catalogue with
+    descriptions and art, so only the names are kept in a cache that's
+    rebuilt when a library file's mtime changes. """
+    cache = load_json(HEROIC_CACHE) or {}
+    libraries = {}
+    changed = False
+    for library in glob.glob(f"{HEROIC_DIR}/store_cache/*_library.json"):
+        mtime = os.stat(library).st_mtime_ns
+        entry = cache.get(library)
+        if not entry or entry['mtime'] != mtime:
+            try:
+                with open(library, 'r', encoding='utf-8') as file:
+                    games = [
+                        [game['runner'], game['app_name'], game['title'],
+                         game.get('folder_name')]
+                        for game in json.load(file)['library']]
+            except (ValueError, KeyError, TypeError):
+                games = []
+            entry = {"mtime": mtime, "games": games}
+            changed = True
+        libraries[library] = entry
+    # Also drops libraries that were removed
+    if changed or len(libraries) != len(cache):
+        save_json(HEROIC_CACHE, libraries)
+    return {
+        (runner, app): (title, folder)
+        for entry in libraries.values()
+        for runner, app, title, folder in entry['games']}
+
+
 def run_heroic(install_dir) -> dict:
     """ Run epic game """
-    # Generate a list of all executables, get the parent directory, and convert
-    # to a set and back into a list to remove redundant items.
-    installed = [
-        path.split('/')[-2] for path in glob.glob(
-            os.path.expanduser(f'{install_dir}/*/*.exe'))]
-    installed = list(set(installed))
-
+    titles = heroic_titles()
+    installed = heroic_installed()
+    if installed is None:
+        # Heroic without install metadata, guess from folders with an exe
+        folders = {
+            entry.name for entry in scan_dir(install_dir, files=False)
+            if glob.glob(f"{glob.escape(entry.path)}/*.exe")}
+        installed = [
+            (runner, app, title)
+            for (runner, app), (title, folder) in titles.items()
+            if folder in folders]
     games = {}
-    for library in glob.glob(os.path.expanduser(
-        "~/.config/heroic/store_cache/*_library.json"
-    )):
-        try:
-            with open(library, 'r', encoding='utf-8') as file:
-                library = json.load(file)
-                for game in library['library']:
-                    if game['folder_name'] in installed:
-                        runner = game['runner']
-                        name = f"{game['title']} [{runner}]"
-                        games[name] = \
-                            ["xdg-open", f"heroic://launch/{runner}"
-                                f"/{game['app_name']}"]
-        except KeyError:
-            pass
+    for runner, app, title in installed:
+        title = titles.get((runner, app), (title,))[0] or title or app
+        games[f"{title} [{runner}]"] = \
+            ["xdg-open", f"heroic://launch/{runner}/{app}"]
     return games
 
 
@@ -92,9 +271,8 @@ def name_from_path(path):
 def run_cemu(rom_dir) -> dict:
     """ Run cemu games """
     return {
-        f"{rom} [cemu]": ["cemu", "--game", f"{rom_dir}/{rom}"]
-        for rom in os.listdir(rom_dir)
-        if os.path.isdir(f"{rom_dir}/{rom}")
+        f"{entry.name} [cemu]": ["cemu", "--game", entry.path]
+        for entry in scan_dir(rom_dir, files=False)
     }
 
 
@@ -104,23 +282,19 @@ def run_switch(game_dir, command):
     if not os.path.isdir(game_dir):
         print("Path does not exist.", file=sys.stderr)
         sys.exit(1)
-    for path in glob.glob(f"{game_dir}/*"):
+    for entry in scan_dir(game_dir):
         name = None
         game = None
-        if ".nsp" in path:
-            name = name_from_path(path)
-            game = path
-        else:
-            try:
-                path = sorted({
-                    item: os.path.getsize(item)
-                    for item in glob.glob(f"{path}/*")
-                    if not os.path.isdir(item)
-                })[0]
-                name = f"{name_from_path(path)} [switch]"
-                game = path
-            except IndexError:
-                pass
+        if ".nsp" in entry.name:
+            name = name_from_path(entry.path)
+            game = entry.path
+        elif entry.is_dir():
+            # Use the first file by name in the game's folder
+            game = min(
+                (item.path for item in scan_dir(entry.path, dirs=False)),
+                default=None)
+            if game:
+                name = f"{name_from_path(game)} [switch]"
         if name and game:
             games[name] = command + [game]
     return games
@@ -128,108 +302,280 @@ def run_switch(game_dir, command):
 
 def run_rpcs3(game_dir):
     games = {}
-    for path in glob.glob(f"{game_dir}/*"):
-        if os.path.isdir(path):
-            name = f"{path.split('/')[-1]} [rpcs3]"
-            games[name] = ["rpcs3", "--no-gui", "--fullscreen", path]
+    for entry in scan_dir(game_dir, files=False):
+        name = f"{entry.name} [rpcs3]"
+        games[name] = ["rpcs3", "--no-gui", "--fullscreen", entry.path]
     return games
 
 
 def run_pcsx2(game_dir):
     games = {}
-    for path in glob.glob(f"{game_dir}/*"):
-        if os.path.isdir(path):
-            name = f"{path.split('/')[-1]} [pcsx2]"
-            games[name] = ["pcsx2", "-fullscreen", "-bigpicture", path]
-        elif 'iso' in path:
-            name = path.split('/')[-1].split('.')[0].split('(')[0].strip()
+    for entry in scan_dir(game_dir):
+        if entry.is_dir():
+            name = f"{entry.name} [pcsx2]"
+        elif 'iso' in entry.name:
+            name = entry.name.split('.')[0].split('(')[0].strip()
             name = f"{name} [pcsx2]"
-            games[name] = ["pcsx2", "-fullscreen", "-bigpicture", path]
+        else:
+            continue
+        games[name] = ["pcsx2", "-fullscreen", "-bigpicture", entry.path]
     return games
 
 
 def run_retroarch(game_dir, cores) -> dict:
     """ Run game with retroarch """
     games = {}
-    for path in glob.glob(f"{os.path.expanduser(game_dir)}/*/*.*"):
-        ext = path.split('.')[-1]
-        # Extension blacklist
-        if ext in ["txt", "sav"]:
+    for core in scan_dir(game_dir, files=False):
+        if core.name not in cores:
             continue
-        core = path.split('/')[-2]
-        if core in list(cores):
-            name = f"{name_from_path(path)} [{core}]"
+        # Extension blacklist
+        for entry in scan_dir(core.path, dirs=False, exclude=["txt", "sav"]):
+            # Only files with an extension count as games
+            if '.' not in entry.name:
+                continue
+            name = f"{name_from_path(entry.path)} [{core.name}]"
             games[name] = [
                 # 'pygame', '-mgo',
                 'retroarch', '-f',
-                '-L', cores[core],
-                path
+                '-L', cores[core.name],
+                entry.path
             ]
     return games
 
 
-def run_bottles(config):
-    if 'flatpak' in config and config['flatpak']:
+def bottles_dir(config) -> str:
+    """ Get the directory bottles keeps its bottles in """
+    if config.get('flatpak'):
+        return os.path.expanduser(
+            '~/.var/app/com.usebottles.bottles/data/bottles/bottles')
+    return os.path.expanduser('~/.local/share/bottles/bottles')
+
+
+def bottle_names(config) -> list:
+    """ Get the configured bottle, list of bottles, or every bottle """
+    bottles = config.get('bottle')
+    if isinstance(bottles, str):
+        return [bottles]
+    if bottles:
+        return bottles
+    return [entry.name for entry in scan_dir(bottles_dir(config), files=False)]
+
+
+def bottle_programs(path) -> list:
+    """ Get the names of a bottle's external programs """
+    # Only pay for importing yaml when a bottle has changed
+    # pylint: disable=import-outside-toplevel
+    import yaml
+    # libyaml's loader is much faster on bottles with lots of dependencies
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(path, 'r', encoding='utf-8') as file:
+        try:
+            bottle = yaml.load(file, Loader=loader)
+            return [
+                info['name'] for info in
+                (bottle.get('External_Programs') or {}).values()]
+        except (yaml.YAMLError, AttributeError, KeyError, TypeError) as error:
+            print(f"Skipping bottle {path}: {error}", file=sys.stderr)
+            return []
+
+
+def run_bottles(config) -> dict:
+    """ Run bottles programs. Each bottle's programs are cached by the mtime
+    of its bottle.yml, so unchanged bottles cost a stat. """
+    if config.get('flatpak'):
         command = [
             'flatpak', 'run', '--command=bottles-cli',
             'com.usebottles.bottles']
-        path = os.path.expanduser(
-            '~/.var/app/com.usebottles.bottles/data/bottles')
     else:
-        command = ['bottles-cli', 'run']
-        path = os.path.expanduser('~/.local/share/bottles')
+        command = ['bottles-cli']
+    pre_command = config.get('pre-command') or []
+
+    cache = load_json(BOTTLES_CACHE)
+    bottles = {}
+    programs = {}
+    changed = False
+    for bottle in bottle_names(config):
+        path = f'{bottles_dir(config)}/{bottle}/bottle.yml'
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        entry = cache.get(path)
+        if not entry or entry['mtime'] != mtime:
+            entry = {"mtime": mtime, "programs": bottle_programs(path)}
+            changed = True
+        bottles[path] = entry
+        programs[bottle] = entry['programs']
+    # Also drops bottles that were removed
+    if changed or len(bottles) != len(cache):
+        save_json(BOTTLES_CACHE, bottles)
+    return {
+        f"{program} [bottles-{bottle}]":
+            pre_command + command + ['run', '-b', bottle, '-p', program]
+        for bottle, names in programs.items() for program in names
+    }
 
-    if 'pre-command' in config and config['pre-command']:
-        pre_command = config['pre-command']
-    else:
-        pre_command = []
 
-    with open(f'{path}/bottles/{config["bottle"]}/bottle.yml', 'r') as file:
-        try:
+def scan_launcher(launcher, settings) -> dict:
+    """ Scan a single launcher for games """
+    match launcher.lower():
+        case "steam":
+            return run_steam(settings)
+        case "heroic":
+            return run_heroic(settings['path'])
+        case "yuzu":
+            return run_switch(settings['path'], ["yuzu", "-f", "-g"])
+        case "switch":
+            return run_switch(settings['path'], settings['command'])
+        case "rpcs3":
+            return run_rpcs3(settings['path'])
+        case "pcsx2":
+            return run_pcsx2(settings['path'])
+        case "retroarch":
+            return run_retroarch(settings['path'], settings['cores'])
+        case "cemu":
+            return run_cemu(settings['path'])
+        case "bottles":
+            return run_bottles(settings)
+        case "custom":
             return {
-                f"{info['name']} [bottles-{config['bottle']}]":
-                    pre_command + command +
-                    ['run', '-b', config['bottle'], '-p', info['name']]
-                for id, info in
-                yaml.safe_load(file)['External_Programs'].items()
-            }
-        except yaml.YAMLError:
-            return None
+                f"{item} [custom]": command for item, command in
+                settings['games'].items()}
+        case _:
+            return {}
 
 
-def sort_dict(dictionary) -> dict:
-    """ Sort dictionary based on values """
-    return dict(sorted(dictionary.items(), key=lambda x: x[1], reverse=True))
+def subdirs(path) -> list:
+    """ Get a list of subdirectories in a path """
+    return [entry.path for entry in scan_dir(path, files=False)]
 
 
-def get_frequent(cache_file) -> list:
-    """ Get ordered list """
+def launcher_paths(launcher, settings) -> list:
+    """ Get the paths whose mtimes invalidate a launcher's index entry """
+    match launcher.lower():
+        case "steam":
+            return [
+                os.path.expanduser(
+                    "~/.local/share/Steam/steamapps/libraryfolders.vdf")
+            ] + [f"{path}/steamapps" for path in steam_libraries(settings)]
+        case "heroic":
+            install_dir = os.path.expanduser(settings['path'])
+            store = f"{HEROIC_DIR}/store_cache"
+            installed = [
+                f"{HEROIC_DIR}/{path}" for path in HEROIC_INSTALLED.values()]
+            paths = [store] + installed + \
+                glob.glob(f"{store}/*_library.json")
+            if not any(os.path.exists(path) for path in installed):
+                paths += [install_dir] + subdirs(install_dir)
+            return paths
+        case "yuzu" | "switch" | "retroarch":
+            path = os.path.expanduser(settings['path'])
+            return [path] + subdirs(path)
+        case "rpcs3" | "pcsx2" | "cemu":
+            return [os.path.expanduser(settings['path'])]
+        case "bottles":
+            path = bottles_dir(settings)
+            return [path] + [
+                f'{path}/{bottle}/bottle.yml'
+                for bottle in bottle_names(settings)]
+        case _:
+            return []
+
+
+def path_mtime(path):
+    """ Get the mtime of a path or None if it doesn't exist """
     try:
-        with open(cache_file, 'r', encoding='utf-8') as file:
-            cache = json.load(file)
-    except (FileNotFoundError, json.decoder.JSONDecodeError):
-        cache = []
-    unique = set(cache)
-    counted = {item: cache.count(item) for item in unique}
-    return list(sort_dict(counted))
-
-
-def sort_some(full, some) -> list:
-    """ Move active VMs to top of list """
-    for item in some:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_launcher(launcher, settings, entry) -> tuple:
+    """ Get games for a launcher from its index entry, rescanning if stale.
+    Returns the games and the new index entry, or None if it's unchanged. """
+    key = json.dumps(settings, sort_keys=True)
+    if (
+        entry and entry['key'] == key and
+        all(path_mtime(path) == mtime
+            for path, mtime in entry['mtimes'].items())
+    ):
+        return entry['games'], None
+    # Record mtimes before scanning so changes made mid-scan aren't missed
+    mtimes = {
+        path: path_mtime(path) for path in launcher_paths(launcher, settings)}
+    games = scan_launcher(launcher, settings) or {}
+    # Launchers without source paths (custom) are cheap and never indexed
+    if not mtimes:
+        return games, None
+    return games, {"key": key, "mtimes": mtimes, "games": games}
+
+
+def scan_all(config, index) -> tuple:
+    """ Scan enabled launchers concurrently and merge them in config order.
+    Launchers that don't finish within their timeout or fail keep the games
+    from their last scan so a stalled mount doesn't hold up the rest of the
+    menu. Returns the games and the launchers that couldn't be scanned. """
+    results = {}
+
+    def worker(launcher, settings):
         try:
-            full.remove(item)
-        except ValueError:
-            some.remove(item)
-    return some + full
-
+            with trace(f"scan {launcher}"):
+                results[launcher] = get_launcher(
+                    launcher, settings, index.get(launcher))
+        except KeyError as error:
+            print(f'Skipping {launcher} due to a configuration error:')
+            print(f'{type(error).__name__}: {error}', file=sys.stderr)
+        except (OSError, SystemExit) as error:
+            print(f'Skipping {launcher} due to a scan error:', file=sys.stderr)
+            print(f'{type(error).__name__}: {error}', file=sys.stderr)
+
+    start = time.monotonic()
+    threads = {}
+    for launcher, settings in config.items():
+        if settings["enable"]:
+            # Daemon threads so a hung NFS read can't block exiting either
+            threads[launcher] = threading.Thread(
+                target=worker, args=(launcher, settings), daemon=True)
+            threads[launcher].start()
 
-def main() -> None:
-    """ Load launcher from config """
-    config_path = os.path.expanduser("~/.config/fuzzel/fuzzel-game.json")
+    games = {}
+    failed = set()
+    changed = False
+    for launcher, thread in threads.items():
+        timeout = config[launcher].get("timeout", DEFAULT_TIMEOUT)
+        thread.join(max(0, start + timeout - time.monotonic()))
+        if thread.is_alive():
+            print(f'Skipping {launcher}: timed out after {timeout}s',
+                  file=sys.stderr)
+        if thread.is_alive() or launcher not in results:
+            failed.add(launcher)
+            # Keep what the last scan found rather than losing the launcher
+            results[launcher] = (index.get(launcher, {}).get('games', {}),
+                                 None)
+        entries, entry = results[launcher]
+        settings = config[launcher]
+        try:
+            passes = compile_filter(
+                settings.get("include"), settings.get("exclude"),
+                ignore_case=True)
+            entries = {
+                name: command for name, command in entries.items()
+                if passes(name)}
+        except re.error as error:
+            print(f'Not filtering {launcher}: {error}', file=sys.stderr)
+        games.update(entries)
+        if entry:
+            index[launcher] = entry
+            changed = True
+    if changed:
+        save_json(INDEX_FILE, index)
+    return games, failed
+
+
+def load_config() -> dict:
+    """ Load launcher config, creating a default one if it doesn't exist """
     try:
-        with open(config_path, 'r', encoding='utf-8') as config_file:
-            config = json.load(config_file)
+        config = read_config(CONFIG_FILE)
     except FileNotFoundError:
         config = {
             "steam": {"enable": True},
@@ -260,7 +606,7 @@ def main() -> None:
                 }
             }
         }
-        with open(config_path, 'w', encoding='utf-8') as config_file:
+        with open(CONFIG_FILE, 'w', encoding='utf-8') as config_file:
             config_file.write(json.dumps(config, indent=4))
             with Popen(
                 [
@@ -269,62 +615,127 @@ def main() -> None:
                     "edit ~/.config/fuzzel/fuzzel-game.json"]):
                 pass
             sys.exit(1)
+    return config
 
-    games = {}
-    for launcher, settings in config.items():
-        if settings["enable"]:
+
+def watch_paths(index) -> set:
+    """ Get every path the index depends on that currently exists """
+    return {
+        path for entry in index.values()
+        for path, mtime in entry['mtimes'].items() if mtime is not None}
+
+
+def wait_for_change(paths, interval) -> None:
+    """ Wait until a watched path changes or the poll interval runs out.
+    Network filesystems don't deliver inotify events for remote changes, so
+    the interval doubles as the polling fallback. """
+    try:
+        # pylint: disable=import-outside-toplevel
+        from inotify_simple import INotify, flags
+    except ImportError:
+        time.sleep(interval)
+        return
+    mask = flags.CREATE | flags.DELETE | flags.MOVED_FROM | \
+        flags.MOVED_TO | flags.CLOSE_WRITE | flags.ATTRIB | \
+        flags.DELETE_SELF | flags.MOVE_SELF
+    with INotify() as inotify:
+        for path in paths:
             try:
-                match launcher.lower():
-                    case "steam":
-                        games.update(run_steam(config[launcher]))
-                    case "heroic":
-                        games.update(run_heroic(config[launcher]['path']))
-                    case "yuzu":
-                        games.update(run_switch(config[launcher]['path'],
-                                                ["yuzu", "-f", "-g"]))
-                    case "switch":
-                        games.update(run_switch(config[launcher]['path'],
-                                                config[launcher]['command']))
-                    case "rpcs3":
-                        games.update(run_rpcs3(config[launcher]['path']))
-                    case "pcsx2":
-                        games.update(run_pcsx2(config[launcher]['path']))
-                    case "retroarch":
-                        games.update(
-                            run_retroarch(config[launcher]['path'],
-                                          config[launcher]['cores']))
-                    case "cemu":
-                        games.update(
-                            run_cemu(config[launcher]['path']))
-                    case "bottles":
-                        games.update(
-                            run_bottles(config[launcher]))
-                    case "custom":
-                        games.update({
-                            f"{item} [custom]": command for item, command in
-                            config[launcher]['games'].items()})
-                    case _:
-                        pass
-            except KeyError as error:
-                print(f'Skipping {launcher} due to a configuration error:')
-                print(f'{type(error).__name__}: {error}', file=sys.stderr)
-                continue
+                inotify.add_watch(path, mask)
+            except OSError:
+                pass
+        # Wait a moment after the first event so bursts cause one rescan
+        inotify.read(timeout=interval * 1000, read_delay=500)
 
-    cache_file = os.path.expanduser('~/.cache/fuzzel-game.json')
-    frequent = get_frequent(cache_file)
-    games_list = sort_some(list(games), frequent)
-    selection = get_selection(games_list)
+
+def run_daemon(interval) -> None:
+    """ Keep the merged game table up to date in the background """
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with open(PID_FILE, 'w', encoding='utf-8') as file:
+        file.write(str(os.getpid()))
+    index = load_json(INDEX_FILE)
+    table = None
     try:
-        with open(cache_file, 'r+', encoding='utf-8') as file:
-            cache = json.load(file)
-    except (FileNotFoundError, json.decoder.JSONDecodeError):
-        cache = []
-    cache = ([selection] + cache)[:20]
-    with open(cache_file, 'w', encoding='utf-8') as file:
-        file.write(json.dumps(cache))
-    print(games[selection])
-    with Popen(games[selection]):
-        pass
+        while True:
+            config = load_config()
+            games, _ = scan_all(config, index)
+            if games != table:
+                save_json(TABLE_FILE, games)
+                table = games
+            wait_for_change(watch_paths(index) | {CONFIG_FILE}, interval)
+    finally:
+        os.remove(PID_FILE)
+
+
+def refresh_table(config) -> tuple:
+    """ Scan every launcher and save the table for the next run's menu.
+    Returns the games and the launchers that couldn't be scanned and had no
+    earlier scan to keep games from. """
+    index = load_json(INDEX_FILE)
+    games, failed = scan_all(config, index)
+    save_json(TABLE_FILE, games)
+    return games, {launcher for launcher in failed if launcher not in index}
+
+
+def resolve(selection, snapshot, games, missing):
+    """ Find a game picked from the snapshot in the refreshed table, by name
+    or else by command in case it was renamed. Returns its name and command,
+    or None and notifies if it's gone. Games can't be ruled out while
+    launchers in missing couldn't be scanned. """
+    if selection in games:
+        return selection, games[selection]
+    for name, command in games.items():
+        if command == snapshot[selection]:
+            return name, command
+    if missing:
+        return selection, snapshot[selection]
+    notify("fuzzel-game", f"{selection} is no longer installed.")
+    return None
+
+
+def main() -> None:
+    """ Load launcher from config """
+    args = parser.parse_args()
+    if args.daemon:
+        run_daemon(args.interval)
+        return
+
+    config = load_config()
+    refreshed = []
+    refresher = None
+    with trace("scan"):
+        # The daemon or the last run leave the menu behind as a snapshot
+        games = load_json(TABLE_FILE)
+        if not games:
+            games, _ = refresh_table(config)
+        elif not pid_alive(PID_FILE):
+            # Show the snapshot straight away and rebuild it while fuzzel is
+            # up. Not a daemon thread, so cancelling still saves it.
+            refresher = threading.Thread(
+                target=lambda: refreshed.extend(refresh_table(config)))
+            refresher.start()
+
+    cache_file = os.path.expanduser('~/.cache/fuzzel-game.json')
+    with trace("rank", games=len(games)):
+        history = load_history(cache_file)
+        ranked = rank_history(games, history)
+    with trace("menu"):
+        selection = get_selection(ranked)
+    command = games[selection]
+    if refresher:
+        with trace("refresh"):
+            refresher.join()
+        # Launch from the snapshot if the refresh itself failed
+        if refreshed:
+            found = resolve(selection, games, *refreshed)
+            if found is None:
+                return
+            selection, command = found
+    with trace("launch"):
+        record_history(cache_file, selection)
+        print(command)
+        with Popen(command):
+            pass
 
 
 if __name__ == "__main__":
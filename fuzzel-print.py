@@ -2,10 +2,23 @@
 """
 Author: thnikk
 """
+# pylint: disable=wrong-import-position
+if __name__ == "__main__":
+    # Hand off to fuzzel-server.py before paying for any imports
+    import client
+    client.forward()
+
 import urllib.parse as up
 import argparse
-from subprocess import Popen, PIPE
-import requests
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from common import (
+    get_selection, load_json, save_json, pid_alive, trace)
 
 parser = argparse.ArgumentParser(
     description="Quick fuzzel moonraker interface")
@@ -13,22 +26,119 @@ parser.add_argument('ip', action='store', type=str, help='ip:port')
 parser.add_argument('-n', action='store', type=int, help='Number of printers')
 parser.add_argument(
     '-f', action="store_true", help='Enable pro and misc filter')
+parser.add_argument(
+    '-s', action="store_true", help='Show printer status in the picker')
+parser.add_argument(
+    '--watch', action="store_true",
+    help='Keep printer status up to date over websockets for the menu')
 args = parser.parse_args()
 
+# Seconds to wait for a printer's status before showing it as offline
+STATUS_TIMEOUT = 1
+# Seconds between walking every directory when refreshing the file index
+FULL_REFRESH = 60 * 60
+# Seconds without a message before pinging a watched printer
+WATCH_TIMEOUT = 30
+# Seconds to wait before reconnecting to a printer
+RECONNECT = 5
+STATUS_FILE = os.path.expanduser('~/.cache/fuzzel-print-status.json')
+PID_FILE = os.path.expanduser('~/.cache/fuzzel-print.pid')
+SUBSCRIBE = {"print_stats": None, "virtual_sdcard": None}
+SESSION = None
 
-def get_fuzzel(input_list, prompt):
-    """ Get selection from fuzzel"""
-    if len(input_list) < 10:
-        length = len(input_list)
-    else:
-        length = 10
-    with Popen(
-        ["fuzzel", "--dmenu", "-l", str(length), "-p", prompt],
-        stdin=PIPE, stdout=PIPE, stderr=PIPE
-    ) as fuzzel:
-        selection = fuzzel.communicate(
-            input=bytes("\n".join(input_list), 'utf-8'))[0]
-        return selection.decode().strip()
+
+def session():
+    """ Get a shared keep-alive session for all moonraker requests """
+    global SESSION  # pylint: disable=global-statement
+    if SESSION is None:
+        # Importing requests takes longer than the rest of the script, so
+        # only do it once it's needed.
+        # pylint: disable=import-outside-toplevel
+        import requests
+        from requests.adapters import HTTPAdapter
+        SESSION = requests.Session()
+        # Keep a connection open to each printer
+        adapter = HTTPAdapter(
+            pool_connections=args.n or 1, pool_maxsize=args.n or 1)
+        SESSION.mount("http://", adapter)
+    return SESSION
+
+
+def get(url, timeout=3):
+    """ Get json from moonraker """
+    with trace("request", url=url):
+        return session().get(url, timeout=timeout).json()
+
+
+def post(url):
+    """ Send a command to moonraker """
+    with trace("request", url=url):
+        session().post(url, timeout=3)
+
+
+def printer_address(num):
+    """ Get the address of a printer, incrementing the port by its number """
+    split_ip = args.ip.split(":")
+    return f"{split_ip[0]}:{int(split_ip[1])+num-1}"
+
+
+def parse_status(status):
+    """ Get the state, progress and file from moonraker's status objects """
+    try:
+        return {
+            "state": status["print_stats"]["state"],
+            "progress": status["virtual_sdcard"]["progress"],
+            "filename": status["print_stats"]["filename"]
+        }
+    except (KeyError, TypeError):
+        return None
+
+
+def get_status(server):
+    """ Get the state, progress and file of a printer """
+    # pylint: disable=import-outside-toplevel
+    from requests.exceptions import RequestException
+    try:
+        return parse_status(get(
+            f"http://{server}/printer/objects/query?print_stats"
+            "&virtual_sdcard", timeout=STATUS_TIMEOUT)["result"]["status"])
+    except (RequestException, ValueError, KeyError):
+        return None
+
+
+def watched_statuses():
+    """ Get every printer's status objects from the watcher, or None if it
+    isn't running """
+    if not pid_alive(PID_FILE):
+        return None
+    return load_json(STATUS_FILE)
+
+
+def status_label(num, status):
+    """ Format a printer's status for the picker """
+    if status is None:
+        return f"{num}: offline"
+    if status["state"] in ("printing", "paused"):
+        return (f"{num}: {status['state']} {status['progress']:.0%} "
+                f"{status['filename']}")
+    return f"{num}: {status['state']}"
+
+
+def get_statuses(nums):
+    """ Get every printer's status from the watcher, querying the ones it
+    doesn't have in parallel """
+    addresses = {num: printer_address(num) for num in nums}
+    watched = watched_statuses() or {}
+    statuses = {
+        num: parse_status(watched[address])
+        for num, address in addresses.items() if address in watched}
+    missing = [num for num in nums if num not in statuses]
+    if missing:
+        session()
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            statuses.update(zip(missing, executor.map(
+                get_status, [addresses[num] for num in missing])))
+    return {num: statuses[num] for num in nums}
 
 
 def url_append_query(url, dictionary):
@@ -40,42 +150,190 @@ def url_append_query(url, dictionary):
     return up.urlunparse(parts)
 
 
-def get_filtered_list(server, match):
-    """ Get filtered list of printable files """
-    file_list_raw = requests.get(
-        f"http://{server}/server/files/list", timeout=3).json()
-    return [file["path"] for file in file_list_raw["result"]
-            if file["path"].startswith(match)]
+def list_directory(server, path):
+    """ Get the files and subdirectories of one directory with their mtimes """
+    result = get(f"http://{server}/server/files/directory?"
+                 f"path={up.quote(path)}")["result"]
+    return {
+        "files": {file["filename"]: file["modified"]
+                  for file in result["files"]},
+        "dirs": {folder["dirname"]: folder["modified"]
+                 for folder in result["dirs"]}
+    }
+
+
+def refresh_index(server, index, path, full=False):
+    """ Refresh a directory in the file index, only descending into
+    subdirectories whose mtime changed unless full is set """
+    old = index.get(path)
+    listing = list_directory(server, path)
+    index[path] = listing
+    for dirname, modified in listing["dirs"].items():
+        child = f"{path}/{dirname}"
+        if full or not old or child not in index or \
+                old["dirs"].get(dirname) != modified:
+            refresh_index(server, index, child, full)
+    # Forget directories that were removed
+    if old:
+        for dirname in set(old["dirs"]) - set(listing["dirs"]):
+            removed = f"{path}/{dirname}"
+            for key in [key for key in index if key == removed or
+                        key.startswith(f"{removed}/")]:
+                del index[key]
+
+
+def index_files(index, path):
+    """ Get (path relative to gcodes, mtime) for every file under a path """
+    listing = index.get(path, {"files": {}, "dirs": {}})
+    prefix = path.removeprefix("gcodes").lstrip("/")
+    for filename, modified in listing["files"].items():
+        yield (f"{prefix}/{filename}" if prefix else filename, modified)
+    for dirname in listing["dirs"]:
+        yield from index_files(index, f"{path}/{dirname}")
+
 
+def update_index(server, cache_file, cache, scope):
+    """ Refresh the file index for a scope and save it """
+    # Changes more than one level below an unchanged directory don't change
+    # its mtime, so walk everything once in a while.
+    full = time.time() - cache["full"] > FULL_REFRESH
+    try:
+        refresh_index(server, cache["dirs"], scope, full)
+    except (OSError, ValueError, KeyError) as error:
+        print(f"Couldn't refresh file index: {error}", file=sys.stderr)
+        return
+    if full:
+        cache["full"] = time.time()
+    save_json(cache_file, cache)
 
-def get_file_list(server):
-    """ Get filtered list of printable files """
-    file_list_raw = requests.get(
-        f"http://{server}/server/files/list", timeout=3).json()
-    return [file["path"] for file in file_list_raw["result"]]
+
+def get_file_list(server, scope="gcodes"):
+    """ Get printable files under a directory, most recent first. Files come
+    from a local index when there is one, which is refreshed in the
+    background while the picker is open. """
+    cache_file = os.path.expanduser(
+        f"~/.cache/fuzzel-print-{server.replace(':', '-')}.json")
+    cache = load_json(cache_file) or {"full": 0, "dirs": {}}
+    if scope in cache["dirs"]:
+        files = list(index_files(cache["dirs"], scope))
+        # Not a daemon thread, so a quick pick doesn't cut the refresh short
+        threading.Thread(
+            target=update_index,
+            args=(server, cache_file, cache, scope)).start()
+    else:
+        update_index(server, cache_file, cache, scope)
+        files = list(index_files(cache["dirs"], scope))
+    return [path for path, _ in sorted(
+        files, key=lambda file: file[1], reverse=True)]
 
 
 def get_macro_list(server):
     """ Get list of macros """
-    file_list_raw = requests.get(
-        f"http://{server}/printer/gcode/help", timeout=3).json()
+    file_list_raw = get(
+        f"http://{server}/printer/gcode/help")
     return list(file_list_raw['result'])
 
 
 def get_last_file(server):
     """ Get last printed file """
-    file = requests.get(f"http://{server}/printer/objects/query?webhooks" +
-                        "&virtual_sdcard&print_stats", timeout=3).json()
+    watched = parse_status((watched_statuses() or {}).get(server))
+    if watched:
+        return watched["filename"]
+    file = get(f"http://{server}/printer/objects/query?webhooks" +
+               "&virtual_sdcard&print_stats")
     return file["result"]["status"]["print_stats"]["filename"]
 
 
+def watch_printer(server, statuses, lock):
+    """ Keep a printer's status objects up to date over moonraker's websocket
+    with printer.objects.subscribe """
+    # pylint: disable=import-outside-toplevel
+    import websocket
+    subscribe = json.dumps({
+        "jsonrpc": "2.0", "method": "printer.objects.subscribe",
+        "params": {"objects": SUBSCRIBE}, "id": 1})
+    while True:
+        try:
+            connection = websocket.create_connection(
+                f"ws://{server}/websocket", timeout=WATCH_TIMEOUT)
+            connection.send(subscribe)
+            while True:
+                try:
+                    message = json.loads(connection.recv())
+                except websocket.WebSocketTimeoutException:
+                    # Make sure a quiet printer is still there
+                    connection.ping()
+                    continue
+                with lock:
+                    if message.get("id") == 1:
+                        statuses[server] = message["result"]["status"]
+                    elif message.get("method") == "notify_status_update" \
+                            and statuses[server] is not None:
+                        for name, fields in message["params"][0].items():
+                            statuses[server].setdefault(name, {}).update(
+                                fields)
+                    elif message.get("method") == "notify_klippy_ready":
+                        # Subscriptions don't survive klipper restarts
+                        connection.send(subscribe)
+                        continue
+                    else:
+                        continue
+                    save_json(STATUS_FILE, statuses)
+        except (OSError, ValueError, KeyError, AttributeError,
+                websocket.WebSocketException) as error:
+            print(f"{server}: {error}", file=sys.stderr)
+            with lock:
+                statuses[server] = None
+                save_json(STATUS_FILE, statuses)
+            time.sleep(RECONNECT)
+
+
+def run_watch():
+    """ Watch every printer until killed """
+    try:
+        # Fail before claiming PID_FILE, or the menu would wait on a watcher
+        # that never writes anything
+        # pylint: disable=import-outside-toplevel,unused-import
+        import websocket
+    except ImportError:
+        sys.exit("--watch needs websocket-client, install it with pip "
+                 "install websocket-client")
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    servers = [printer_address(num) for num in range(1, args.n+1)] \
+        if args.n else [args.ip]
+    statuses = {server: None for server in servers}
+    lock = threading.Lock()
+    with open(PID_FILE, 'w', encoding='utf-8') as file:
+        file.write(str(os.getpid()))
+    try:
+        for server in servers:
+            threading.Thread(
+                target=watch_printer, args=(server, statuses, lock),
+                daemon=True).start()
+        while True:
+            time.sleep(60)
+    finally:
+        os.remove(PID_FILE)
+
+
+if args.watch:
+    run_watch()
+
 # Increment port depending on the selection
-try:
-    NUM = get_fuzzel(
-        [str(n) for n in range(1, args.n+1)], "Select printer: ")
-    split_ip = args.ip.split(":")
-    ip = f"{split_ip[0]}:{int(split_ip[1])+int(NUM)-1}"
-except TypeError:
+if args.n:
+    if args.s:
+        with trace("status", printers=args.n):
+            statuses = get_statuses(list(range(1, args.n+1)))
+        with trace("printer menu"):
+            NUM = get_selection(
+                list(statuses), "Select printer: ", max_lines=10,
+                label=lambda num: status_label(num, statuses[num]))
+    else:
+        with trace("printer menu"):
+            NUM = get_selection(
+                range(1, args.n+1), "Select printer: ", max_lines=10)
+    ip = printer_address(NUM)
+else:
     ip = args.ip
 
 # Make list of operations
@@ -88,44 +346,46 @@ if args.f:
     operations.insert(1, "Print Misc")
 
 # Do actions based on selections
-match get_fuzzel(operations, "Select an operation: "):
+with trace("operation menu"):
+    OPERATION = get_selection(
+        operations, "Select an operation: ", max_lines=10)
+match OPERATION:
     case "Print":
-        if args.f:
-            LIST = get_filtered_list(ip, "pro/")
-        else:
-            LIST = get_file_list(ip)
-        FILE = get_fuzzel(LIST, "Select a file: ")
+        with trace("files"):
+            LIST = get_file_list(ip, "gcodes/pro" if args.f else "gcodes")
+        FILE = get_selection(LIST, "Select a file: ", max_lines=10)
         URL = url_append_query(
             f"http://{ip}/printer/print/start",
             {"filename": FILE})
-        requests.post(URL, timeout=3)
+        post(URL)
     case "Print Misc":
-        LIST = get_filtered_list(ip, "misc/")
-        FILE = get_fuzzel(LIST, "Select a file: ")
+        with trace("files"):
+            LIST = get_file_list(ip, "gcodes/misc")
+        FILE = get_selection(LIST, "Select a file: ", max_lines=10)
         URL = url_append_query(
             f"http://{ip}/printer/print/start",
             {"filename": FILE})
-        requests.post(URL, timeout=3)
+        post(URL)
     case "Reprint":
         FILE = get_last_file(ip)
         URL = url_append_query(
             f"http://{ip}/printer/print/start",
             {"filename": FILE})
-        requests.post(URL, timeout=3)
+        post(URL)
     case "Cancel":
         URL = f"http://{ip}/printer/gcode/script?script=CACNCEL_PRINT"
-        requests.post(URL, timeout=3)
+        post(URL)
     case "Macro":
         LIST = get_macro_list(ip)
-        MACRO = get_fuzzel(LIST, "Select a macro: ")
+        MACRO = get_selection(LIST, "Select a macro: ", max_lines=10)
         URL = f"http://{ip}/printer/gcode/script?script={MACRO}"
-        requests.post(URL, timeout=3)
+        post(URL)
     case "Firmware restart":
         URL = f"http://{ip}/printer/firmware_restart"
-        requests.post(URL, timeout=3)
+        post(URL)
     case "Klipper restart":
         URL = f"http://{ip}/printer/restart"
-        requests.post(URL, timeout=3)
+        post(URL)
     case "Emergency stop":
         URL = f"http://{ip}/printer/emergency_stop"
-        requests.post(URL, timeout=3)
+        post(URL)
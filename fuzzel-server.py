@@ -0,0 +1,194 @@
+#!/usr/bin/python3 -u
+"""
+Description: Optional resident server for the python scripts. It imports the
+modules they use and parses their configs once, then forks a warm copy of
+itself to run each script for its client over a unix socket. Start it with
+your session, the scripts run standalone when it isn't running.
+Author: thnikk
+"""
+import argparse
+import importlib
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+import client
+import common
+
+parser = argparse.ArgumentParser(
+    description="Run the fuzzel scripts from a warm resident process")
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Scripts the server will run
+SCRIPTS = ["fuzzel-game.py", "fuzzel-vm.py", "fuzzel-print.py",
+           "fuzzel-ssh.py"]
+# Modules the scripts import lazily, loaded here if they're installed
+PRELOAD = [
+    "yaml", "requests", "requests.adapters", "requests.exceptions",
+    "websocket", "libvirt", "inotify_simple", "concurrent.futures",
+    "urllib.parse", "glob", "re",
+]
+CONFIG_FILES = [
+    os.path.expanduser("~/.config/fuzzel/fuzzel-game.json"),
+    os.path.expanduser("~/.config/fuzzel/fuzzel-ssh.json"),
+]
+
+
+def preload() -> None:
+    """ Import the modules the scripts use so children start with them """
+    for name in PRELOAD:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+def compile_script(name, compiled) -> object:
+    """ Get a script's code, compiling it again if it changed """
+    path = os.path.join(SCRIPT_DIR, name)
+    mtime = os.stat(path).st_mtime_ns
+    if name not in compiled or compiled[name][0] != mtime:
+        with open(path, 'r', encoding='utf-8') as file:
+            compiled[name] = (mtime, compile(file.read(), path, 'exec'))
+    return compiled[name][1]
+
+
+def warm_configs() -> None:
+    """ Parse configs that changed since the last request """
+    for path in CONFIG_FILES:
+        try:
+            common.read_config(path)
+        except (OSError, ValueError):
+            pass
+
+
+def receive(connection) -> tuple:
+    """ Read a client's request and its stdin, stdout and stderr """
+    message, fds, _, _ = socket.recv_fds(connection, 64 * 1024, 3)
+    while message and not message.endswith(b"\n"):
+        chunk = connection.recv(64 * 1024)
+        if not chunk:
+            break
+        message += chunk
+    return message, fds
+
+
+def run_script(connection, code, request, fds) -> None:
+    """ Run a script in a forked child as if the client had run it """
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    common.TRACE_FILE = os.environ.get("FUZZEL_SCRIPTS_TRACE")
+    common.PROFILE_SPAN = os.environ.get("FUZZEL_SCRIPTS_PROFILE")
+    sys.argv = request["argv"]
+    status = 0
+    try:
+        # pylint: disable=exec-used
+        exec(code, {"__name__": "__main__", "__file__": code.co_filename})
+    except SystemExit as error:
+        if isinstance(error.code, int) or error.code is None:
+            status = error.code or 0
+        else:
+            print(error.code, file=sys.stderr)
+            status = 1
+    except BaseException:  # pylint: disable=broad-except
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        connection.sendall(json.dumps({"status": status}).encode() + b"\n")
+        connection.close()
+    except OSError:
+        pass
+    # Let background work like cache refreshes finish after the client
+    # exits, like the interpreter would
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join()
+    os._exit(0)
+
+
+def serve(listener) -> None:
+    """ Fork a child for each request """
+    compiled = {}
+    while True:
+        connection, _ = listener.accept()
+        fds = []
+        with connection:
+            try:
+                message, fds = receive(connection)
+                # Probes from a server checking if this one is running
+                if not message:
+                    continue
+                request = json.loads(message)
+                name = os.path.basename(request["argv"][0])
+                if name not in SCRIPTS or len(fds) != 3:
+                    # Tell the client to run standalone
+                    connection.sendall(b'{"status": null}\n')
+                    continue
+                code = compile_script(name, compiled)
+                warm_configs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                if os.fork() == 0:
+                    try:
+                        listener.close()
+                        run_script(connection, code, request, fds)
+                    finally:
+                        # Never go back to serving from a child
+                        os._exit(1)
+            except (OSError, ValueError, KeyError, IndexError,
+                    TypeError) as error:
+                print(f"Bad request: {error}", file=sys.stderr)
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+
+def main():
+    """ Main function """
+    parser.parse_args()
+    if not client.SOCKET_FILE:
+        print("XDG_RUNTIME_DIR isn't set, not serving from a shared "
+              "directory", file=sys.stderr)
+        sys.exit(1)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with probe:
+        try:
+            probe.connect(client.SOCKET_FILE)
+            print(f"Already running on {client.SOCKET_FILE}", file=sys.stderr)
+            sys.exit(1)
+        except FileNotFoundError:
+            pass
+        except ConnectionRefusedError:
+            # Left behind by a server that didn't exit cleanly
+            os.remove(client.SOCKET_FILE)
+    client.IN_SERVER = True
+    preload()
+    warm_configs()
+    # Children are never waited for, have the kernel reap them
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(client.SOCKET_FILE)
+    os.chmod(client.SOCKET_FILE, 0o600)
+    listener.listen()
+    try:
+        serve(listener)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove(client.SOCKET_FILE)
+
+
+if __name__ == "__main__":
+    main()
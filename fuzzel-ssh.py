@@ -1,52 +1,281 @@
 #!/usr/bin/python3 -u
 """
-Description: Open SSH session in terminal
+Description: Open SSH session in terminal. Hosts come from the config and
+~/.ssh/config, and the most used ones get multiplexed master connections in
+the background so picking them opens a shell without a new handshake.
 Author: thnikk
 """
-from subprocess import Popen, PIPE
+# pylint: disable=wrong-import-position
+if __name__ == "__main__":
+    # Hand off to fuzzel-server.py before paying for any imports
+    import client
+    client.forward()
+
+from subprocess import Popen, DEVNULL
+import argparse
+import glob
+import re
+import shlex
 import sys
 import json
 import os
+import time
+from common import (
+    get_selection, trace, read_config, load_history,
+    record_history, rank_history, load_json, save_json, notify)
 
+CONFIG_FILE = os.path.expanduser('~/.config/fuzzel/fuzzel-ssh.json')
+HISTORY_FILE = os.path.expanduser('~/.cache/fuzzel-ssh.json')
+SSH_CONFIG = os.path.expanduser('~/.ssh/config')
+CONTROL_DIR = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or "/tmp", "fuzzel-ssh")
+PROBE_FILE = os.path.expanduser('~/.cache/fuzzel-ssh-probe.json')
+# Seconds to wait for a host when opening a master in the background
+WARM_TIMEOUT = 5
+# Seconds to reuse a host's reachability before probing it again
+PROBE_TTL = 60
 
-def notify(subject, body):
-    """ Create notification """
-    print(body)
-    # pylint: disable=consider-using-with
-    Popen(['notify-send', subject, body])
+parser = argparse.ArgumentParser(description="SSH fuzzel launcher")
+parser.add_argument('--warm', type=int, default=3,
+                    help="Number of most used hosts to keep connected.")
+parser.add_argument('--persist', type=str, default="10m",
+                    help="How long idle master connections stay open.")
+parser.add_argument('--deadline', type=float, default=0.25,
+                    help="Seconds to wait for hosts to answer a probe.")
 
 
-def get_selection(input_list, prompt="", max_lines=8) -> str:
-    """ Get selection from list with custom prompt """
-    length = str(min(len(input_list), max_lines))
-    with Popen(
-        ["fuzzel", "--dmenu", "-l", length, "-p", prompt],
-        stdin=PIPE, stdout=PIPE, stderr=PIPE
-    ) as fuzzel:
-        selection = fuzzel.communicate(
-            input=bytes("\n".join(input_list), 'utf-8'))[0]
-        if fuzzel.returncode != 0:
-            sys.exit(1)
-        return selection.decode().strip()
+def ssh_config_hosts(path=SSH_CONFIG, hosts=None, seen=None) -> dict:
+    """ Get the Host aliases without wildcards from an ssh config and the
+    files it includes, with the first HostName, Port and proxy settings
+    from their own Host blocks """
+    hosts = {} if hosts is None else hosts
+    seen = set() if seen is None else seen
+    if path in seen:
+        return hosts
+    seen.add(path)
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            lines = file.readlines()
+    except OSError:
+        return hosts
+    block = []
+    for line in lines:
+        words = re.split(r'\s*=\s*|\s+', line.strip(), maxsplit=1)
+        if len(words) < 2 or words[0].startswith('#'):
+            continue
+        key, value = words[0].lower(), words[1]
+        # A Match block's settings don't belong to the Host before it
+        if key == "match":
+            block = []
+        elif key == "host":
+            block = [
+                alias for alias in value.split()
+                if not any(char in alias for char in "*?!")]
+            for alias in block:
+                hosts.setdefault(alias, {})
+        elif key == "include":
+            for pattern in value.split():
+                # Relative includes are relative to ~/.ssh
+                pattern = os.path.join(
+                    os.path.expanduser('~/.ssh'), os.path.expanduser(pattern))
+                for include in sorted(glob.glob(pattern)):
+                    ssh_config_hosts(include, hosts, seen)
+        elif key in ("hostname", "port", "proxyjump", "proxycommand"):
+            for alias in block:
+                hosts[alias].setdefault(key, value)
+    return hosts
+
+
+def address(target, ssh_hosts):
+    """ Get the host and port to probe for a target, or None if it goes
+    through a proxy """
+    options = ssh_hosts.get(target, {})
+    if "proxyjump" in options or "proxycommand" in options:
+        return None
+    host = options.get("hostname", target.removeprefix("ssh://"))
+    port = options.get("port", 22)
+    host = host.rpartition("@")[2]
+    if host.count(":") == 1:
+        host, port = host.split(":")
+    try:
+        return host, int(port)
+    except ValueError:
+        return None
+
+
+def destination(target) -> str:
+    """ Get what to pass ssh for a target, which can be user@host:port """
+    if "://" not in target and target.count(":") == 1:
+        return f"ssh://{target}"
+    return target
+
+
+async def probe_all(addresses, deadline) -> dict:
+    """ Connect to every address at once and get each one's RTT in ms,
+    "down" if it refused or failed, or "timeout" if it didn't answer in
+    time """
+    # pylint: disable=import-outside-toplevel
+    import asyncio
+
+    async def probe(host, port):
+        start = time.perf_counter()
+        _, writer = await asyncio.open_connection(host, port)
+        writer.close()
+        return round((time.perf_counter() - start) * 1000, 1)
+
+    tasks = {item: asyncio.ensure_future(probe(*item)) for item in addresses}
+    if not tasks:
+        return {}
+    _, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+    for task in pending:
+        task.cancel()
+    # Cancelling doesn't wait for lookups still running in threads
+    await asyncio.gather(*pending, return_exceptions=True)
+    results = {}
+    for item, task in tasks.items():
+        if task in pending:
+            results[item] = "timeout"
+        elif task.exception():
+            results[item] = "down"
+        else:
+            results[item] = task.result()
+    return results
+
+
+def probe_hosts(addresses, deadline) -> dict:
+    """ Get the reachability of addresses, probing ones whose cached result
+    is older than PROBE_TTL. Takes at most the deadline. """
+    cache = load_json(PROBE_FILE)
+    now = time.time()
+    stale = {
+        item for item in addresses
+        if now - cache.get(f"{item[0]}:{item[1]}", {}).get("time", 0)
+        > PROBE_TTL}
+    if stale:
+        # Most runs reuse the cache, only pay for importing asyncio to probe
+        # pylint: disable=import-outside-toplevel
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(probe_all(stale, deadline))
+        finally:
+            # Don't wait for lookups that missed the deadline
+            loop.close()
+        for (host, port), result in results.items():
+            cache[f"{host}:{port}"] = {"time": now, "result": result}
+        save_json(PROBE_FILE, cache)
+    return {
+        item: cache[f"{item[0]}:{item[1]}"]["result"] for item in addresses}
+
+
+def host_label(name, result) -> str:
+    """ Show a host's RTT or why it's unreachable """
+    if result is None:
+        return name
+    if isinstance(result, str):
+        return f"{name} ({result})"
+    return f"{name} ({result:.0f}ms)"
+
+
+def reachability(result) -> tuple:
+    """ Sort key putting reachable hosts first by order of magnitude of RTT,
+    then hosts that can't be probed, then unreachable ones """
+    if result is None:
+        return (1, 0)
+    if isinstance(result, str):
+        return (2, 0)
+    return (0, len(str(int(result))))
+
+
+def control_options(persist) -> list:
+    """ Get ssh options to share a master connection per host, or none if
+    CONTROL_DIR isn't a private directory of this user's """
+    try:
+        os.makedirs(CONTROL_DIR, mode=0o700, exist_ok=True)
+        # Someone else could have created it first when it's under /tmp
+        info = os.lstat(CONTROL_DIR)
+    except OSError:
+        info = None
+    if info is None or os.path.islink(CONTROL_DIR) or \
+            not os.path.isdir(CONTROL_DIR) or \
+            info.st_uid != os.getuid() or info.st_mode & 0o077:
+        print(f"Not sharing connections, {CONTROL_DIR} isn't private",
+              file=sys.stderr)
+        return []
+    return [
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPath={CONTROL_DIR}/%C",
+        "-o", f"ControlPersist={persist}"]
+
+
+def warm_hosts(targets, persist) -> None:
+    """ Open master connections to hosts in the background unless they're
+    already open. They close themselves once idle for persist. """
+    options = " ".join(shlex.quote(option)
+                       for option in control_options(persist))
+    if not options:
+        return
+    for target in targets:
+        target = shlex.quote(target)
+        # BatchMode so hosts that need a password are skipped, not prompted
+        # pylint: disable=consider-using-with
+        Popen(
+            ["sh", "-c",
+             f"ssh {options} -O check {target} || "
+             f"ssh {options} -o BatchMode=yes "
+             f"-o ConnectTimeout={WARM_TIMEOUT} -fN {target}"],
+            stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+            start_new_session=True)
 
 
 def main():
     """ Main function """
-    config_file = os.path.expanduser('~/.config/fuzzel/fuzzel-ssh.json')
-    try:
-        with open(config_file, 'r', encoding='utf-8') as file:
-            config = json.loads(file.read())
-    except FileNotFoundError:
-        with open(config_file, 'w', encoding='utf-8') as file:
+    args = parser.parse_args()
+    with trace("config"):
+        try:
+            config = read_config(CONFIG_FILE)
+        except FileNotFoundError:
+            config = None
+        hosts = dict(config or {})
+        ssh_hosts = ssh_config_hosts()
+        # Hosts from the ssh config, unless the config already has them
+        targets = set(hosts.values())
+        for alias in ssh_hosts:
+            if alias not in hosts and alias not in targets:
+                hosts[alias] = alias
+    if config is None and not hosts:
+        with open(CONFIG_FILE, 'w', encoding='utf-8') as file:
             ex_config = {'nickname': 'user@IP'}
             file.write(json.dumps(ex_config))
-            notify('fuzzel-ssh', f'Default config created in {config_file}, '
+            notify('fuzzel-ssh', f'Default config created in {CONFIG_FILE}, '
                    'please edit before running again.')
             sys.exit(1)
 
-    selection = get_selection(list(config))
-    # pylint: disable=consider-using-with
-    Popen(['wezterm', 'ssh', config[selection]])
+    history = load_history(HISTORY_FILE)
+    addresses = {
+        name: address(target, ssh_hosts) for name, target in hosts.items()}
+    with trace("probe", hosts=len(hosts)):
+        probed = probe_hosts(
+            {item for item in addresses.values() if item}, args.deadline)
+    results = {
+        name: probed.get(item) if item else None
+        for name, item in addresses.items()}
+    frecent = rank_history(list(hosts), history)
+    # Stable, so hosts stay in frecency order within each group
+    ranked = sorted(frecent, key=lambda name: reachability(results[name]))
+    # Connect to the most used hosts while the menu is open
+    warm_hosts([destination(hosts[name]) for name in frecent[:args.warm]
+                if name in history and results[name] != "down"],
+               args.persist)
+    with trace("menu", hosts=len(hosts)):
+        selection = get_selection(
+            ranked, label=lambda name: host_label(name, results[name]))
+    with trace("launch"):
+        record_history(HISTORY_FILE, selection)
+        # OpenSSH rather than wezterm's own client so the master is used
+        # pylint: disable=consider-using-with
+        Popen(['wezterm', 'start', '--', 'ssh'] +
+              control_options(args.persist) + [destination(hosts[selection])])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,158 @@
+#!/usr/bin/python3 -u
+"""
+Description: List videos in a directory or cache file with their tags
+stripped and open the selected one in MPV. Directories are kept in a local
+index that's refreshed incrementally using directory mtimes.
+Author: thnikk
+"""
+from subprocess import Popen, DEVNULL
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import threading
+from common import get_selection, scan_dir
+
+parser = argparse.ArgumentParser(description="Fuzzel video launcher")
+parser.add_argument('path', type=str, help="Video directory or cache file")
+args = parser.parse_args()
+
+DB_FILE = os.path.expanduser('~/.cache/fuzzel-video.db')
+EXTENSIONS = ["mkv", "mp4", "mov", "avi"]
+TAGS = re.compile(r"\[[^][]*\]|\([^()]*\)")
+
+
+def clean_title(path) -> str:
+    """ Strip the directory, tags, extension and underscores from a path """
+    title = TAGS.sub("", os.path.basename(path))
+    title = os.path.splitext(title)[0]
+    return title.replace("_", " ").strip()
+
+
+def open_db():
+    """ Open the index, creating it if needed """
+    db = sqlite3.connect(DB_FILE)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY, parent TEXT, mtime INTEGER);
+        CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, dir TEXT, mtime INTEGER, title TEXT);
+        CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+        CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime);
+    """)
+    return db
+
+
+def forget_dir(db, path) -> None:
+    """ Remove a directory and everything under it from the index """
+    pattern = path.replace("\\", "\\\\").replace("%", "\\%") \
+        .replace("_", "\\_") + "/%"
+    db.execute("DELETE FROM dirs WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+               (path, pattern))
+    db.execute("DELETE FROM files WHERE dir = ? OR dir LIKE ? ESCAPE '\\'",
+               (path, pattern))
+
+
+def refresh_dir(db, path, parent=None, seen=None) -> None:
+    """ Refresh a directory in the index. Directories whose mtime hasn't
+    changed cost one stat, their files aren't listed again. """
+    seen = set() if seen is None else seen
+    try:
+        stat = os.stat(path)
+    except OSError:
+        forget_dir(db, path)
+        return
+    # Don't follow symlink loops
+    if (stat.st_dev, stat.st_ino) in seen:
+        return
+    seen.add((stat.st_dev, stat.st_ino))
+    mtime = stat.st_mtime_ns
+    row = db.execute(
+        "SELECT mtime FROM dirs WHERE path = ?", (path,)).fetchone()
+    if row and row[0] == mtime:
+        subdirs = [sub for (sub,) in db.execute(
+            "SELECT path FROM dirs WHERE parent = ?", (path,))]
+    else:
+        subdirs = []
+        files = []
+        for entry in scan_dir(path, include=EXTENSIONS, hidden=True):
+            # Follow symlinks and list hidden files like find -L
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            else:
+                try:
+                    files.append((entry.path, path, entry.stat().st_mtime_ns,
+                                  clean_title(entry.name)))
+                except OSError:
+                    pass
+        old = {sub for (sub,) in db.execute(
+            "SELECT path FROM dirs WHERE parent = ?", (path,))}
+        for removed in old - set(subdirs):
+            forget_dir(db, removed)
+        db.execute("DELETE FROM files WHERE dir = ?", (path,))
+        db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                       files)
+        db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                   (path, parent, mtime))
+    for sub in subdirs:
+        refresh_dir(db, sub, path, seen)
+
+
+def refresh(root) -> None:
+    """ Refresh the index for a root directory in its own connection """
+    db = open_db()
+    with db:
+        refresh_dir(db, root)
+    db.close()
+
+
+def indexed_videos(db, root) -> list:
+    """ Get (path, title) for every indexed video under a root, newest first
+    like the old find | sort -r pipeline """
+    pattern = root.replace("\\", "\\\\").replace("%", "\\%") \
+        .replace("_", "\\_") + "/%"
+    return db.execute(
+        "SELECT path, title FROM files WHERE dir = ? OR dir LIKE ? "
+        "ESCAPE '\\' ORDER BY mtime DESC", (root, pattern)).fetchall()
+
+
+def main():
+    """ Main function """
+    refresher = None
+    if os.path.isdir(args.path):
+        root = os.path.realpath(args.path)
+        db = open_db()
+        known = db.execute(
+            "SELECT 1 FROM dirs WHERE path = ?", (root,)).fetchone()
+        if not known:
+            refresh(root)
+        videos = indexed_videos(db, root)
+        db.close()
+        if known:
+            # Show the index straight away and refresh it while fuzzel is up
+            refresher = threading.Thread(target=refresh, args=(root,))
+            refresher.start()
+    elif os.path.isfile(args.path):
+        with open(args.path, 'r', encoding='utf-8') as file:
+            videos = [(line.strip(), clean_title(line.strip()))
+                      for line in file if line.strip()]
+    else:
+        print("Please enter valid cache file or directory", file=sys.stderr)
+        sys.exit(1)
+
+    selection = get_selection(
+        videos, max_lines=15, label=lambda video: video[1])[0]
+    command = ["mpv"]
+    # Add profile to command for given directory
+    if "anime" in selection.lower():
+        command.append("--profile=anime")
+    # pylint: disable=consider-using-with
+    Popen(command + [selection], stdout=DEVNULL)
+    if refresher:
+        refresher.join()
+
+
+if __name__ == "__main__":
+    main()
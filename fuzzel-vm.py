@@ -4,110 +4,221 @@ Description: Do VM operations with Fuzzel. This script keeps a cache of which
 VMs are opened and puts the most frequently used/active at the top of the list.
 Author: thnikk
 """
-from subprocess import Popen, PIPE, run
+# pylint: disable=wrong-import-position
+if __name__ == "__main__":
+    # Hand off to fuzzel-server.py before paying for any imports
+    import client
+    client.forward()
+
+from subprocess import TimeoutExpired, run
+from concurrent.futures import ThreadPoolExecutor, CancelledError
 import sys
-import json
 import os
+import re
+import threading
 import argparse
+from common import (
+    get_selection, load_history, record_history, rank_history, trace,
+    compile_filter, notify)
 
 parser = argparse.ArgumentParser(description="VM fuzzel launcher")
 parser.add_argument(
     'filter', type=str,
-    nargs='*', help="Filter for blacklist")
+    nargs='*', help="Filter for blacklist. Substrings, or glob: and re: "
+    "patterns.")
 parser.add_argument('-w', action='store_true',
                     help="Change blacklist to whitelist.")
+parser.add_argument('-c', '--connect', type=str,
+                    help="Hypervisor URI, e.g. test:///default")
+parser.add_argument('-g', action='store_true',
+                    help="Apply an operation to every filtered VM.")
+parser.add_argument('-j', type=int, default=4,
+                    help="Number of VMs to operate on at once with -g.")
+parser.add_argument('-t', type=int, default=120,
+                    help="Seconds to wait for each VM with -g.")
 args = parser.parse_args()
 
 
-def vm_list() -> list:
-    """ Get a list of VMs """
-    output = run(
-        ["virsh", "list", "--all", "--name"],
-        capture_output=True, check=False
-    ).stdout.decode('utf-8').strip().splitlines()
-    return output
-
-
-def vm_active() -> list:
-    """ Get a list of VMs """
-    output = run(
-        ["virsh", "list", "--name"],
-        capture_output=True, check=False
-    ).stdout.decode('utf-8').strip().splitlines()
-    return output
-
-
-def sort_some(all, some) -> list:
-    """ Move active VMs to top of list """
-    for item in some:
+def connect():
+    """ Open one libvirt connection, or None to fall back to virsh """
+    try:
+        # Imported here so the virsh fallback doesn't pay for it
+        # pylint: disable=import-outside-toplevel
+        import libvirt
+    except ImportError:
+        return None
+    # Don't print libvirt's errors, the fallback handles them
+    libvirt.registerErrorHandler(lambda *_: None, None)
+    try:
+        return libvirt.open(args.connect)
+    except libvirt.libvirtError:
+        return None
+
+
+def virsh(*command, timeout=None):
+    """ Run a virsh command against the configured URI """
+    uri = ["-c", args.connect] if args.connect else []
+    # virsh translates its table headers, which are parsed by vm_states
+    result = run(
+        ["virsh"] + uri + list(command), capture_output=True, check=False,
+        timeout=timeout, env=dict(os.environ, LC_ALL="C"))
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode('utf-8').strip())
+    return result.stdout.decode('utf-8')
+
+
+def vm_states(conn) -> dict:
+    """ Get a dictionary of VM names and whether they're active """
+    if conn:
+        # pylint: disable=import-outside-toplevel
+        import libvirt
+        inactive = (libvirt.VIR_DOMAIN_NOSTATE, libvirt.VIR_DOMAIN_SHUTOFF,
+                    libvirt.VIR_DOMAIN_CRASHED)
+        # One round trip for every domain's name and state
+        return {
+            domain.name(): stats['state.state'] not in inactive
+            for domain, stats in
+            conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE)}
+    try:
+        lines = virsh("list", "--all").splitlines()
+    except RuntimeError as error:
+        print(error, file=sys.stderr)
+        return {}
+    if not lines:
+        return {}
+    # Names can contain spaces, so use the header's column positions
+    name_column = lines[0].index("Name")
+    state_column = lines[0].index("State")
+    return {
+        line[name_column:state_column].strip():
+            line[:name_column].strip() != "-"
+        for line in lines[2:] if line.strip()}
+
+
+def domain_operation(conn, operation, name) -> None:
+    """ Start, shutdown, reboot or destroy a VM with libvirt """
+    domain = conn.lookupByName(name)
+    match operation:
+        case "start":
+            domain.create()
+        case "shutdown":
+            domain.shutdown()
+        case "reboot":
+            domain.reboot()
+        case "destroy":
+            domain.destroy()
+
+
+def vm_operation(conn, operation, name, timeout=None) -> None:
+    """ Start, shutdown, reboot or destroy a VM, raising TimeoutError if it
+    takes longer than timeout seconds """
+    if not conn:
+        virsh(operation, name, timeout=timeout)
+        return
+    if timeout is None:
+        domain_operation(conn, operation, name)
+        return
+    errors = []
+
+    def worker():
         try:
-            all.remove(item)
-        except ValueError:
-            some.remove(item)
-    return some + all
-
-
-def get_selection(input_list, prompt="") -> str:
-    """ Get selection from list with custom prompt """
-    length = str(min(len(input_list), 8))
-    with Popen(
-        ["fuzzel", "--dmenu", "-l", length, "-p", prompt],
-        stdin=PIPE, stdout=PIPE, stderr=PIPE
-    ) as fuzzel:
-        selection = fuzzel.communicate(
-            input=bytes("\n".join(input_list), 'utf-8'))[0]
-        if fuzzel.returncode != 0:
-            sys.exit(1)
-        return selection.decode().strip()
-
-
-def sort_dict(dictionary) -> dict:
-    """ Sort dictionary based on values """
-    return dict(sorted(dictionary.items(), key=lambda x: x[1], reverse=True))
+            domain_operation(conn, operation, name)
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+
+    # libvirt calls can't be interrupted, so a hung one is left behind on a
+    # daemon thread
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"{operation} took longer than {timeout}s")
+    if errors:
+        raise errors[0]
+
+
+def group_operation(conn, operation, vms) -> dict:
+    """ Run an operation on several VMs at once, returning each VM's result.
+    Each VM gets -t seconds from when a worker starts it, so VMs queued
+    behind slow ones aren't timed out before they run. """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, args.j)) as executor:
+        futures = {
+            vm: executor.submit(vm_operation, conn, operation, vm, args.t)
+            for vm in vms}
+        for vm, future in futures.items():
+            try:
+                future.result()
+                results[vm] = "ok"
+            except (TimeoutError, TimeoutExpired):
+                results[vm] = "timed out"
+            except CancelledError:
+                results[vm] = "not started"
+            except Exception as error:  # pylint: disable=broad-except
+                # RuntimeError from virsh or libvirtError
+                results[vm] = f"failed: {error}"
+    return results
 
 
 def filter_list(item_list, filter_strings, invert=False) -> list:
     """ Create list using filter strings as whitelist/blacklist filter """
-    # temp_list = []
-    # for item in item_list:
-    #     for filter_string in filter_strings:
-    #         print(filter_string, item, filter_string in item)
-    #         if filter_string in item:
-    #             temp_list.append(item)
-    temp_list = [
-        item for item in item_list
-        for filter_string in filter_strings
-        if filter_string in item
-    ]
     if invert:
-        return temp_list
-    return sorted(list(set(item_list) - set(temp_list)))
+        passes = compile_filter(include=filter_strings)
+    else:
+        passes = compile_filter(exclude=filter_strings)
+    return sorted(item for item in item_list if passes(item))
 
 
 def main():
     """ Main function """
     cache_file = os.path.expanduser('~/.cache/fuzzel-vm.json')
-    try:
-        with open(cache_file, 'r', encoding='utf-8') as file:
-            cache = json.load(file)
-    except (FileNotFoundError, json.decoder.JSONDecodeError):
-        cache = []
-    unique = set(cache)
-    counted = {item: cache.count(item) for item in unique}
-    filtered_list = filter_list(vm_list(), args.filter, args.w)
-    sorted_cache = sort_some(filtered_list, list(sort_dict(counted)))
-    active = vm_active()
-    sorted_active = sort_some(sorted_cache, active)
-    selection = get_selection(sorted_active)
+    with trace("states"):
+        conn = connect()
+        states = vm_states(conn)
+    with trace("rank", vms=len(states)):
+        history = load_history(cache_file)
+        try:
+            filtered_list = filter_list(list(states), args.filter, args.w)
+        except re.error as error:
+            parser.error(f"invalid filter: {error}")
+        active = {vm for vm, running in states.items() if running}
+        # Active VMs first, then by frecency
+        ranked = sorted(
+            rank_history(filtered_list, history),
+            key=lambda vm: vm not in active)
+    if args.g:
+        operation = get_selection(
+            ["start", "shutdown", "reboot", "destroy"], "Select an option: ")
+        # Only start inactive VMs and only stop active ones
+        targets = [
+            vm for vm in ranked if (vm in active) != (operation == "start")]
+        with trace("group operation", operation=operation,
+                   vms=len(targets)):
+            results = group_operation(conn, operation, targets)
+        for vm, result in results.items():
+            if operation == "start" and result == "ok":
+                record_history(cache_file, vm)
+        notify(f'fuzzel-vm {operation}', "\n".join(
+            f"{vm}: {result}" for vm, result in results.items()
+        ) or "No VMs to change.")
+        return
+    with trace("menu"):
+        selection = get_selection(ranked)
     if selection in active:
-        operation = get_selection(["shutdown", "reboot", "destroy"],
-                                  "Select an option: ")
-        run(["virsh", operation, selection], check=False)
+        with trace("operation menu"):
+            operation = get_selection(["shutdown", "reboot", "destroy"],
+                                      "Select an option: ")
     else:
-        run(["virsh", "start", selection], check=False)
-        cache = ([selection] + cache)[:20]
-        with open(cache_file, 'w', encoding='utf-8') as file:
-            file.write(json.dumps(cache, indent=4))
+        operation = "start"
+    with trace("operation", operation=operation):
+        try:
+            vm_operation(conn, operation, selection)
+        except Exception as error:  # pylint: disable=broad-except
+            # RuntimeError from virsh or libvirtError
+            notify(f'fuzzel-vm {operation}', f"{selection}: failed: {error}")
+            sys.exit(1)
+        if operation == "start":
+            record_history(cache_file, selection)
 
 
 if __name__ == "__main__":